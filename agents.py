@@ -1,93 +1,274 @@
 import os
-from azure.search.documents import SearchClient
-from azure.search.documents.models import VectorizableTextQuery
-from azure.search.documents.models import QueryType, QueryCaptionType, QueryAnswerType
-from azure.core.credentials import AzureKeyCredential
-from openai import AzureOpenAI
+import hashlib
+import asyncio
+import re
 from ragHelper import read_topics_from_file
+from cacheHelper import TTLCache
+from llmCache import get_llm_cache, cache_key
+from clientRegistry import REGISTRY
+import tracing
+from retriever import AzureRetriever, LocalRetriever
+from embeddingHelper import embed_texts, normalize
+from promptBudget import PromptBudget, format_sources, format_qna, count_tokens
 from dotenv import load_dotenv
+import json
+import logging
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Shared by every agent in the process, so identical searches issued by
+# different turns or sessions only reach Azure AI Search once per TTL.
+SEARCH_CACHE = TTLCache(
+    maxsize=int(os.environ.get("SEARCH_CACHE_SIZE", "256")),
+    ttl=float(os.environ.get("SEARCH_CACHE_TTL", "600"))
+)
+
+
+# Leading section numbering of source titles, e.g. "12. " or "1.2. "
+_TITLE_NUMBER_RE = re.compile(r"^\s*\d+(\.\d+)*\.\s+")
+
 
 class SearchAgentConfig:
-    def __init__(self, endpoint=None, index=None, credential=None):
+    # local_index: path of a retriever.py index to search instead of Azure AI Search;
+    # key_field: the Azure index's document key field
+    def __init__(self, endpoint=None, index=None, credential=None, local_index=None, key_field=None):
         self.endpoint = endpoint
         self.index = index
         self.credential = credential
+        self.local_index = local_index
+        self.key_field = key_field or os.environ.get("AZURE_SEARCH_KEY_FIELD", "id")
 
 
 class Agent:
     # Constructor
+    # Clients and the retriever are created on first use, so building agents
+    # (e.g. when run.py is imported) costs nothing until they are needed
     def __init__(self, config):
+        self.search_config = config
         if config is not None:
-            self.search_client = self.get_search_client(config)
-        self.openai_client = self.get_openai_client()
+            self.search_index = config.local_index or config.index
+        self._retriever = None
+        self._search_client = None
+        self._openai_client = None
+        self._async_search_client = None
+        self._async_openai_client = None
+
+    # Get retriever backing Agent.search
+    def get_retriever(self, conf):
+        if conf.local_index:
+            return LocalRetriever(conf.local_index)
+        return AzureRetriever(self.search_client, lambda: self.async_search_client,
+                              key_field=conf.key_field)
+
+    # Clients come from the process-wide registry, so every agent and
+    # session shares one connection pool per service
 
     # Get search client for this agent
     def get_search_client(self, conf):
-        search_client = SearchClient(
-            endpoint=conf.endpoint,
-            index_name=conf.index,
-            credential=AzureKeyCredential(conf.credential),
-            # api_version=conf.api_version
-        )
-        return search_client
+        return REGISTRY.search_client(conf)
 
     # Get openai client for this agent
     def get_openai_client(self):
-        return AzureOpenAI(
-            azure_endpoint=os.environ.get("AZURE_OPENAI_ENDPOINT"),
-            api_key=os.environ.get("AZURE_OPENAI_KEY"),
-            api_version=os.environ.get("AZURE_OPENAI_API_VERSION")
-        )
+        return REGISTRY.openai_client()
+
+    # Get async search client for this agent
+    def get_async_search_client(self, conf):
+        return REGISTRY.async_search_client(conf)
+
+    # Get async openai client for this agent
+    def get_async_openai_client(self):
+        return REGISTRY.async_openai_client()
+
+    @property
+    def retriever(self):
+        if self._retriever is None:
+            self._retriever = self.get_retriever(self.search_config)
+        return self._retriever
+
+    @property
+    def search_client(self):
+        if self._search_client is None:
+            self._search_client = self.get_search_client(self.search_config)
+        return self._search_client
+
+    @property
+    def openai_client(self):
+        if self._openai_client is None:
+            self._openai_client = self.get_openai_client()
+        return self._openai_client
+
+    @property
+    def async_search_client(self):
+        if self._async_search_client is None:
+            self._async_search_client = self.get_async_search_client(self.search_config)
+        return self._async_search_client
+
+    @property
+    def async_openai_client(self):
+        if self._async_openai_client is None:
+            self._async_openai_client = self.get_async_openai_client()
+        return self._async_openai_client
 
     # RAG component - Search
     def search(self, query, top_k=5, filter=None, vector_search=False, language="en-us"):
         if (query is None or query == ""):
             return {}
+        return format_sources(
+            self.search_sources(query, top_k, filter, vector_search, language))
 
-        FILTERSTR = "search.in(topic, '{}' , '|')"
-        filter = FILTERSTR.format(
-            '|'.join(["{}".format(topic) for topic in filter])) if filter else None
-
-        # vector search
-        if vector_search:
-            vector_query = VectorizableTextQuery(
-                text=query, k=1, fields="vector", exhaustive=True)
-
-        client: SearchClient = self.search_client
-        results = client.search(
-            search_text=query,
-            vector_queries=[vector_query] if vector_search else None,
-            query_type=QueryType.SEMANTIC,  semantic_configuration_name="default",
-            query_caption=QueryCaptionType.EXTRACTIVE, query_answer=QueryAnswerType.EXTRACTIVE,
-            top=top_k,
-            filter=filter,
-            query_language=language
-        )
-
-        source_information = ""
-        for result in results:
-            splice_index = result["title"].find(
-                ". ", 0, 5) + 2 if result["title"].find(". ", 0, 5) != -1 else 0
-            source_information += "\n{title: '" + \
-                result["title"][splice_index:] + \
-                "', content: '" + result['content'] + "'},\n"
-
-        return source_information
+    # Ranked list of source records (see _to_source), cached across agents and turns
+    def search_sources(self, query, top_k=5, filter=None, vector_search=False, language="en-us"):
+        if (query is None or query == ""):
+            return []
+
+        cache_key = (self.search_index, query, tuple(filter) if filter else None,
+                     top_k, vector_search, language)
+        with tracing.span("search") as span:
+            span.cache_hit = True
+
+            def compute():
+                span.cache_hit = False
+                return self._search(query, top_k, filter, vector_search, language)
+            return SEARCH_CACHE.get_or_compute(cache_key, compute)
+
+    # Source record: document key, title without its numbering, content,
+    # search and reranker scores, extractive captions and semantic answers;
+    # the key is the retriever's key field, or a content hash without one
+    def _to_source(self, result):
+        key = result.get(self.retriever.key_field) or hashlib.sha256(
+            (result["title"] + "\0" + result["content"]).encode("utf8")).hexdigest()[:16]
+        return {
+            "key": key,
+            "title": _TITLE_NUMBER_RE.sub("", result["title"]),
+            "content": result["content"],
+            "score": result.get("@search.score"),
+            "reranker_score": result.get("@search.reranker_score"),
+            "captions": [caption.text for caption in result.get("@search.captions") or []],
+            "answers": list(result.get("@search.answers") or []),
+        }
+
+    def _search(self, query, top_k, filter, vector_search, language):
+        results = self.retriever.search(query, top_k, filter, vector_search, language)
+        return [self._to_source(result) for result in results]
+
+    async def asearch(self, query, top_k=5, filter=None, vector_search=False, language="en-us"):
+        if (query is None or query == ""):
+            return {}
+        return format_sources(
+            await self.asearch_sources(query, top_k, filter, vector_search, language))
 
-    # RAG component - Ask
-    def send_messages(self, messages):
-        openai_client: AzureOpenAI = self.openai_client
-        response = openai_client.chat.completions.create(
+    async def asearch_sources(self, query, top_k=5, filter=None, vector_search=False, language="en-us"):
+        if (query is None or query == ""):
+            return []
+
+        cache_key = (self.search_index, query, tuple(filter) if filter else None,
+                     top_k, vector_search, language)
+        with tracing.span("search") as span:
+            span.cache_hit = True
+
+            def compute():
+                span.cache_hit = False
+                return self._asearch(query, top_k, filter, vector_search, language)
+            return await SEARCH_CACHE.aget_or_compute(cache_key, compute)
+
+    async def _asearch(self, query, top_k, filter, vector_search, language):
+        # Loading a local index reads it from disk, so not on the event loop
+        retriever = self._retriever or await tracing.to_thread(lambda: self.retriever)
+        results = await retriever.asearch(query, top_k, filter, vector_search, language)
+        return [self._to_source(result) for result in results]
+
+    # Chat completion parameters, also the persistent LLM cache key
+    def _chat_params(self, messages):
+        return dict(
             model=os.environ.get("AZURE_OPENAI_CHAT_DEPLOYMENT"),
             messages=messages,
             temperature=0.5,
             # max_tokens = 2048,
             n=1
         )
-        return response.choices[0].message
+
+    # Estimated prompt size, charged against the deployment's token limit
+    def _prompt_tokens(self, messages):
+        return sum(count_tokens(message["content"]) for message in messages)
+
+    # (cache, key, cached message or None); cache is None when there is no
+    # persistent LLM cache or it is in passthrough mode
+    def _cached_chat(self, params):
+        cache = get_llm_cache()
+        if cache is None or not cache.enabled:
+            return None, None, None
+        key = cache_key("chat", **params)
+        value = cache.get(key)
+        if value is None:
+            return cache, key, None
+        from openai.types.chat import ChatCompletionMessage
+        return cache, key, ChatCompletionMessage(role="assistant", content=json.loads(value)["content"])
+
+    def _store_chat(self, cache, key, content):
+        if cache is not None:
+            cache.put(key, "chat", json.dumps({"content": content}, ensure_ascii=False).encode("utf8"))
+
+    # RAG component - Ask
+    # With stream=True, returns a generator of content deltas instead of the message
+    def send_messages(self, messages, stream=False):
+        params = self._chat_params(messages)
+        if stream:
+            return self._stream_deltas(params)
+        with tracing.span("chat") as span:
+            cache, key, message = self._cached_chat(params)
+            if cache is not None:
+                span.cache_hit = message is not None
+            if message is None:
+                response = REGISTRY.call(
+                    params["model"], lambda: self.openai_client.chat.completions.create(**params),
+                    tokens=self._prompt_tokens(messages))
+                span.record_usage(response.usage)
+                REGISTRY.limits(params["model"]).charge(response.usage and response.usage.completion_tokens)
+                message = response.choices[0].message
+                self._store_chat(cache, key, message.content)
+        return message
+
+    def _stream_deltas(self, params):
+        # Usage is not reported on streamed responses, so only time is recorded
+        with tracing.span("chat") as span:
+            cache, key, message = self._cached_chat(params)
+            if cache is not None:
+                span.cache_hit = message is not None
+            if message is not None:
+                yield message.content
+                return
+            response = REGISTRY.call_stream(
+                params["model"], lambda: self.openai_client.chat.completions.create(**params, stream=True),
+                tokens=self._prompt_tokens(params["messages"]))
+            chunks = []
+            try:
+                for chunk in response:
+                    # Azure sends a leading chunk with no choices (content filter results)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        chunks.append(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+            finally:
+                # Frees the deployment's concurrency slot if the reader stops early
+                response.close()
+            self._store_chat(cache, key, "".join(chunks))
+
+    async def asend_messages(self, messages):
+        params = self._chat_params(messages)
+        with tracing.span("chat") as span:
+            cache, key, message = self._cached_chat(params)
+            if cache is not None:
+                span.cache_hit = message is not None
+            if message is None:
+                response = await REGISTRY.acall(
+                    params["model"], lambda: self.async_openai_client.chat.completions.create(**params),
+                    tokens=self._prompt_tokens(messages))
+                span.record_usage(response.usage)
+                REGISTRY.limits(params["model"]).charge(response.usage and response.usage.completion_tokens)
+                message = response.choices[0].message
+                self._store_chat(cache, key, message.content)
+        return message
 
     def generate_conversation(self):
         raise NotImplementedError("generate_messages not implemented")
@@ -95,8 +276,106 @@ class Agent:
     def RAG(self, query):
         raise NotImplementedError("RAG not implemented")
 
-
-TOPICS, TOPIC_NAMES = read_topics_from_file()
+    async def aRAG(self, query):
+        raise NotImplementedError("aRAG not implemented")
+
+
+# Conversation shared by all agents
+# Q/A turns are appended incrementally and every agent's rendering of the
+# history is cached and extended with only the new turns, instead of each
+# agent re-walking the whole history every turn. Behaves like the list of
+# (question, answer) tuples it replaces.
+
+
+class Conversation:
+    def __init__(self, turns=None, parent=None):
+        self._parent = parent
+        self._turns = list(turns or [])
+        # rendering name -> (text, offsets); offsets[i] is where turn i starts
+        self._rendered = {}
+        # Keys of sources already sent to AnswerAgent in this conversation
+        self._seen = set()
+
+    def append(self, turn):
+        self._turns.append(tuple(turn))
+
+    # A view of this conversation with extra turns, without copying it
+    def extended(self, *turns):
+        return Conversation(turns, parent=self)
+
+    def __add__(self, turns):
+        return self.extended(*turns)
+
+    def __len__(self):
+        return (len(self._parent) if self._parent is not None else 0) + len(self._turns)
+
+    def __iter__(self):
+        if self._parent is not None:
+            yield from self._parent
+        yield from self._turns
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        base = len(self._parent) if self._parent is not None else 0
+        index = index + len(self) if index < 0 else index
+        if index < base:
+            return self._parent[index]
+        return self._turns[index - base]
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def seen_sources(self):
+        return (self._parent.seen_sources() | self._seen) if self._parent is not None else set(self._seen)
+
+    # Marks on an extended() view stay in that view
+    def mark_seen(self, keys):
+        self._seen.update(keys)
+
+    # Approximate bytes held by the turns and cached renderings of this
+    # conversation (not its parent)
+    def memory_size(self):
+        return sum(len(text) for turn in self._turns for text in turn) + \
+            sum(len(text) + 8 * len(offsets) for text, offsets in self._rendered.values())
+
+    def render(self, name, formatter, start=0):
+        if self._parent is not None:
+            base = len(self._parent)
+            prefix = self._parent.render(name, formatter, start) if start < base else ""
+            return prefix + "".join(formatter(turn) for turn in self._turns[max(start - base, 0):])
+
+        text, offsets = self._rendered.get(name, ("", [0]))
+        if len(offsets) <= len(self._turns):
+            # Build new (text, offsets) rather than mutating, so concurrent
+            # readers always see a consistent pair
+            new_parts = [formatter(turn) for turn in self._turns[len(offsets) - 1:]]
+            offsets = list(offsets)
+            for part in new_parts:
+                offsets.append(offsets[-1] + len(part))
+            text += "".join(new_parts)
+            self._rendered[name] = (text, offsets)
+        return text[offsets[start]:] if start else text
+
+
+def render_history(chat_history, name, formatter, start=0):
+    if isinstance(chat_history, Conversation):
+        return chat_history.render(name, formatter, start)
+    return "".join(formatter(chat) for chat in chat_history[start:])
+
+
+def format_question(chat):
+    return "- " + chat[0] + "\n"
+
+
+# TOPICS and TOPIC_NAMES are read from topic_translation.csv on first access
+# (and re-read if the file changes) rather than at import
+def __getattr__(name):
+    if name == "TOPICS":
+        return read_topics_from_file()[0]
+    if name == "TOPIC_NAMES":
+        return read_topics_from_file()[1]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # Topic Agent
 
@@ -142,7 +421,7 @@ class TopicAgent(Agent):
     """
 
         conversation = [
-            {'role': 'system', 'content': system_message + TOPICS},
+            {'role': 'system', 'content': system_message + read_topics_from_file()[0]},
             {'role': 'user', 'content': "I recently rented an apartment in Hong Kong, and after moving in, I discovered that there is a severe mold problem. The landlord was aware of the issue but did not disclose it to me before signing the lease agreement. I'm concerned about my health and want to know if I have any legal rights in this situation."},
             {'role': 'assistant', 'content': answer},
             {'role': 'user', 'content': query}
@@ -155,6 +434,73 @@ class TopicAgent(Agent):
         answer = self.send_messages(messages)
         return answer
 
+    async def aRAG(self, query):
+        messages = self.generate_conversation(query)
+        answer = await self.asend_messages(messages)
+        return answer
+
+
+# Embedding-based Topic Classifier
+# Ranks topics by cosine similarity between the query and each topic's
+# EN/TC/SC names, with one embedding call per query instead of a chat call
+
+
+class TopicClassifier:
+    LANGUAGES = ('en-US', 'zh-HK', 'zh-CN')
+
+    # topic_names defaults to the table in topic_translation.csv, read on
+    # first use and picked up again if the file changes
+    def __init__(self, topic_names=None, cache_dir=None):
+        self._topic_names = topic_names
+        self.cache_dir = cache_dir or os.environ.get(
+            "TOPIC_VECTORS_CACHE", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+        self._loaded = (None, None, None)
+
+    @property
+    def topic_names(self):
+        return self._topic_names if self._topic_names is not None else read_topics_from_file()[1]
+
+    # (topics, normalized name vectors of shape (topics, languages, dim));
+    # vectors are cached on disk keyed on the embedding deployment and the
+    # topic table contents
+    def _topic_vectors(self):
+        import numpy as np
+        topic_names = self.topic_names
+        topics = list(topic_names)
+        names = [topic_names[topic][language]
+                 for topic in topics for language in self.LANGUAGES]
+        digest = hashlib.sha256("\0".join(
+            [str(os.environ.get("AZURE_OPENAI_EMBEDDING_DEPLOYMENT"))] + topics + names
+        ).encode("utf8")).hexdigest()[:16]
+        if self._loaded[0] == digest:
+            return self._loaded[1], self._loaded[2]
+
+        path = os.path.join(self.cache_dir, f"topic_vectors-{digest}.npy")
+        if os.path.exists(path):
+            vectors = np.load(path)
+        else:
+            vectors = normalize(embed_texts(names)).astype(np.float32)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.save(path, vectors)
+        vectors = vectors.reshape(len(topics), len(self.LANGUAGES), -1)
+        self._loaded = (digest, topics, vectors)
+        return topics, vectors
+
+    # All topics with their scores, most relevant first
+    def rank(self, query):
+        import numpy as np
+        topics, vectors = self._topic_vectors()
+        query_vector = normalize(embed_texts([query])[0])
+        scores = (vectors @ query_vector).max(axis=1)
+        order = np.argsort(-scores)
+        return [(topics[i], float(scores[i])) for i in order]
+
+    def top_k(self, query, k=3):
+        return [topic for topic, _ in self.rank(query)[:k]]
+
+    def RAG(self, query):
+        return [topic for topic, _ in self.rank(query)]
+
 
 # Question Raiser Agent
 class QuestionAgent(Agent):
@@ -172,15 +518,16 @@ class QuestionAgent(Agent):
         Do not ask question that were already asked, and do not ask questions that are not related to the client's query.
         """
 
-        previous_questions_formatted = ""
-        for chat in chat_history:
-            previous_questions_formatted += "- " + chat[0] + "\n"
+        previous_questions_formatted = render_history(
+            chat_history, "questions", format_question)
 
+        # History first: the system prompt and earlier questions form a
+        # prefix that stays identical across turns for prompt caching
         conversation = [
             {'role': 'system', 'content': system_message},
             # {'role': 'user', 'content': "Client query:\nI recently rented an apartment in Hong Kong, and after moving in, I discovered that there is a severe mold problem. The landlord was aware of the issue but did not disclose it to me before signing the lease agreement. I'm concerned about my health and want to know if I have any legal rights in this situation.\n\nPrevious questions:\nNone"},
             # {'role': 'assistant', 'content': "Did you document the mold problem in writing or take any photographs as evidence of the condition when you discovered it in the apartment?"},
-            {'role': 'user', 'content': f"Client query:\n{query}\n\nPrevious questions:\n{previous_questions_formatted or 'None'}"}
+            {'role': 'user', 'content': f"Previous questions:\n{previous_questions_formatted or 'None'}\n\nClient query:\n{query}"}
         ]
         return conversation
 
@@ -189,6 +536,15 @@ class QuestionAgent(Agent):
         answer = self.send_messages(messages)
         return answer.content
 
+    async def aRAG(self, query, chat_history=[]):
+        messages = self.generate_conversation(query, chat_history)
+        answer = await self.asend_messages(messages)
+        return answer.content
+
+    def RAG_stream(self, query, chat_history=[]):
+        messages = self.generate_conversation(query, chat_history)
+        yield from self.send_messages(messages, stream=True)
+
 # Mimic User's Question Response Agent
 
 
@@ -202,18 +558,13 @@ class UserResponseAgent(Agent):
         Remember to be concise, effective in your questioning, answer in 2 sentence at most.
         """
 
-        chat_context = f"""## Context
-        - Legal situation: {query}
-
-        ## Previous questions
-        """
-
-        for chat in chat_history:
-            chat_context += f"- Question: {chat[0]}\n- Answer: {chat[1]}\n"
+        chat_context = "## Previous questions\n" + \
+            render_history(chat_history, "qna", format_qna) + \
+            f"\n## Context\n- Legal situation: {query}"
 
         conversation = [
             {'role': 'system', 'content': system_message},
-            {'role': 'user', 'content': f"New Question:\n{system_question}\n\n{chat_context}"}
+            {'role': 'user', 'content': f"{chat_context}\n\nNew Question:\n{system_question}"}
         ]
         return conversation
 
@@ -223,14 +574,207 @@ class UserResponseAgent(Agent):
         answer = self.send_messages(messages)
         return answer.content
 
+    async def aRAG(self, query, system_question, chat_history=[]):
+        messages = self.generate_conversation(
+            query, system_question, chat_history)
+        answer = await self.asend_messages(messages)
+        return answer.content
+
+# Conversation Summary Agent
+# Folds Q/A pairs that no longer fit the prompt budget into a running summary.
+# Summaries are cached by conversation prefix, so each turn only folds the
+# pairs evicted since the previous summary instead of regenerating it.
+
+
+class SummaryAgent(Agent):
+    def __init__(self, cache_size=512):
+        super().__init__(config=None)
+        self._summaries = TTLCache(maxsize=cache_size, ttl=None)
+
+    def generate_conversation(self, summary, chat_history):
+        system_message = """You summarize a conversation between a Hong Kong legal assistant and a client.
+        Update the current summary with the new exchanges. Keep every fact about the client's situation that may matter legally, drop pleasantries.
+        Answer with the updated summary only, in at most 150 words."""
+
+        new_exchanges = ""
+        for chat in chat_history:
+            new_exchanges += format_qna(chat)
+
+        conversation = [
+            {'role': 'system', 'content': system_message},
+            {'role': 'user', 'content': f"Current summary:\n{summary or 'None'}\n\nNew exchanges:\n{new_exchanges}"}
+        ]
+        return conversation
+
+    # Chained keys: keys[i] identifies chat_history[:i + 1]
+    def _prefix_keys(self, chat_history):
+        keys = []
+        key = ""
+        for chat in chat_history:
+            key = hashlib.sha256((key + json.dumps(list(chat), ensure_ascii=False)).encode("utf8")).hexdigest()
+            keys.append(key)
+        return keys
+
+    def _cached_prefix(self, keys):
+        for length in range(len(keys), 0, -1):
+            summary = self._summaries.get(keys[length - 1])
+            if summary is not None:
+                return length, summary
+        return 0, None
+
+    # The summary of the whole of chat_history is computed through
+    # get_or_compute, so concurrent callers (e.g. the real and speculative
+    # answers of a turn) share one fold
+    def RAG(self, chat_history):
+        if not chat_history:
+            return None
+        keys = self._prefix_keys(chat_history)
+
+        def fold():
+            length, summary = self._cached_prefix(keys[:-1])
+            messages = self.generate_conversation(summary, chat_history[length:])
+            return self.send_messages(messages).content
+        return self._summaries.get_or_compute(keys[-1], fold)
+
+    async def aRAG(self, chat_history):
+        if not chat_history:
+            return None
+        keys = self._prefix_keys(chat_history)
+
+        async def fold():
+            length, summary = self._cached_prefix(keys[:-1])
+            messages = self.generate_conversation(summary, chat_history[length:])
+            return (await self.asend_messages(messages)).content
+        return await self._summaries.aget_or_compute(keys[-1], fold)
+
 # Answer Agent
 
 
 class AnswerAgent(Agent):
-    def __init__(self, config):
+    # With a topic_classifier and topic_k > 0, searches are restricted to the
+    # query's topic_k most relevant topics. Prompts are kept within
+    # prompt_budget (a promptBudget.PromptBudget). With an answer_cache (a
+    # semanticCache.SemanticCache), answers to near-identical turns are
+    # reused instead of searching and generating again.
+    # source_text: "content", or "captions" to send sources' extractive
+    # captions where they have them. seen_sources: what to do with sources
+    # already sent earlier in the conversation (see Conversation.mark_seen):
+    # "keep" them, send only their "captions", or "drop" them.
+    # topic_change_margin: see changes_subject.
+    def __init__(self, config, topic_classifier=None, topic_k=0, prompt_budget=None, answer_cache=None,
+                 source_text=None, seen_sources=None, topic_change_margin=None):
         super().__init__(config)
+        self.topic_classifier = topic_classifier
+        self.topic_k = topic_k
+        self.prompt_budget = prompt_budget or PromptBudget()
+        self.summary_agent = SummaryAgent()
+        self.answer_cache = answer_cache
+        self.source_text = source_text or os.environ.get("SOURCE_TEXT", "content")
+        self.seen_sources = seen_sources or os.environ.get("SEEN_SOURCES", "keep")
+        self.topic_change_margin = topic_change_margin or float(os.environ.get("TOPIC_CHANGE_MARGIN", "0.1"))
+
+    @property
+    def filters_topics(self):
+        return self.topic_classifier is not None and self.topic_k > 0
+
+    def search_topics(self, query):
+        if self.topic_classifier is None or self.topic_k <= 0 or not query:
+            return None
+        with tracing.span("topics"):
+            return self.topic_classifier.top_k(query, self.topic_k)
+
+    # Whether query has left topics (e.g. the problem statement's): its own
+    # best topic is not among them and outscores them by topic_change_margin
+    def changes_subject(self, query, topics):
+        with tracing.span("topic_check"):
+            ranked = self.topic_classifier.rank(query)
+        best_topic, best_score = ranked[0]
+        if best_topic in topics:
+            return False
+        kept = max((score for topic, score in ranked if topic in topics), default=0.0)
+        return best_score - kept > self.topic_change_margin
+
+    # Sources for query within topics; when the topics leave nothing, the
+    # search is repeated over every topic rather than answering without sources
+    def topic_search(self, query, topics):
+        sources = self.search_sources(query, filter=topics)
+        if not sources and topics:
+            tracing.note("topic_filter", {"topics": topics, "fallback": True})
+            sources = self.search_sources(query)
+        return sources
+
+    async def atopic_search(self, query, topics):
+        sources = await self.asearch_sources(query, filter=topics)
+        if not sources and topics:
+            tracing.note("topic_filter", {"topics": topics, "fallback": True})
+            sources = await self.asearch_sources(query)
+        return sources
+
+    # Sources an answer to query would be based on; search results are
+    # cached, so a later RAG for the same query does not search again
+    def retrieve(self, query):
+        return self.topic_search(query, self.search_topics(query))
+
+    # (topics, sources) for query, to be passed back as RAG's prefetched;
+    # topics given by the caller are used instead of classifying query
+    async def aretrieve(self, query, topics=None):
+        if topics is None:
+            topics = await tracing.to_thread(self.search_topics, query)
+        return topics, await self.atopic_search(query, topics)
+
+    # Context vector for the answer cache, or None without one
+    def answer_context(self, query, chat_history=[]):
+        if self.answer_cache is None or not query:
+            return None
+        return normalize(embed_texts([self.answer_cache.context_text(query, chat_history)])[0])
+
+    def cached_answer(self, vector, topics):
+        if vector is None:
+            return None
+        with tracing.span("answer_cache") as span:
+            cached = self.answer_cache.get(vector, topics[0] if topics else None)
+            span.cache_hit = cached is not None
+        if cached is None:
+            return None
+        answer, similarity, age = cached
+        tracing.note("answer_cache", {"similarity": similarity, "age": age})
+        return answer
 
-    def generate_conversation(self, query, search_results, chat_history=[]):
+    def cache_answer(self, vector, topics, answer):
+        if vector is not None and answer:
+            self.answer_cache.put(vector, answer, topics[0] if topics else None)
+
+    # Cache answer now, or hand (vector, topics) to the caller via cache_entry
+    def _keep_answer(self, vector, topics, answer, cache_entry):
+        if cache_entry is None:
+            self.cache_answer(vector, topics, answer)
+        elif vector is not None:
+            cache_entry.append((vector, topics))
+
+    # Sources as sent in the prompt, per source_text and seen_sources
+    def prompt_sources(self, sources, chat_history=[]):
+        seen = chat_history.seen_sources() \
+            if self.seen_sources != "keep" and isinstance(chat_history, Conversation) else set()
+        prompt, repeated = [], 0
+        for source in sources:
+            caption = " ... ".join(source.get("captions") or [])
+            if source.get("key") in seen:
+                repeated += 1
+                if self.seen_sources == "drop" or not caption:
+                    continue
+                source = dict(source, content=caption)
+            elif self.source_text == "captions" and caption:
+                source = dict(source, content=caption)
+            prompt.append(source)
+        return prompt, repeated
+
+    # search_results: ranked list of sources from search_sources (or an
+    # already formatted string); history_summary: summary of the Q/A pairs
+    # that do not fit the history budget, from SummaryAgent; used_sources: a
+    # list to which the keys of the sources put in the prompt are appended
+    # start: history_start(chat_history), if the caller already computed it
+    def generate_conversation(self, query, search_results, chat_history=[], history_summary=None,
+                              used_sources=None, start=None):
         system_message = """You are an assistant that helps people with their Hong Kong legal questions by providing answer to user query based on the content in the Provided Sources.
         Explain or elaborate on the legal information in the sources to answer the user query.
         Only elaborate on the sources that are closely related to the user query. DO NOT include the irrelevant sources. 
@@ -243,26 +787,114 @@ class AnswerAgent(Agent):
         # Each paragraph of the summary must have a reference to its source.
         # Use square brackets to reference the source by it's title, e.g. [title of source one]. Don't combine sources, list each source separately, e.g. [title of source one][title of source two]. Do not include the word "title" in the citation, do not index any reference.
 
+        if start is None:
+            start = self.prompt_budget.history_start(chat_history)
         previous_qna = ""
-        for chat in chat_history:
-            previous_qna += "- Question: " + \
-                chat[0] + "\n- Answer: " + chat[1] + "\n"
-
-        user_question_source = "User query: " + query + "\n\nConversation History: " + \
-            previous_qna + "\n\nSources: \n" + search_results
+        if start and history_summary:
+            previous_qna += "Summary of earlier conversation: " + history_summary + "\n"
+        previous_qna += render_history(chat_history, "qna", format_qna, start)
+
+        # History before the query and sources, so consecutive turns share
+        # the longest possible prompt prefix
+        user_question = "Conversation History: " + previous_qna + \
+            "\n\nUser query: " + query + "\n\nSources: \n"
+        fixed_tokens = count_tokens(system_message) + count_tokens(user_question)
+        if isinstance(search_results, str):
+            sources, report = search_results, {"sources_tokens": count_tokens(search_results)}
+        else:
+            search_results, repeated = self.prompt_sources(search_results, chat_history)
+            sources, report = self.prompt_budget.fit_sources(
+                search_results, self.prompt_budget.total - fixed_tokens)
+            report["sources_repeated"] = repeated
+            if used_sources is not None:
+                used_sources.extend(report["source_keys"])
+
+        report.update({
+            "system_tokens": count_tokens(system_message),
+            "query_tokens": count_tokens(query),
+            "history_tokens": count_tokens(previous_qna),
+            "history_pairs": len(chat_history) - start,
+            "history_pairs_summarized": start if history_summary else 0,
+            "history_pairs_dropped": 0 if history_summary else start,
+        })
+        report["total_tokens"] = fixed_tokens + report["sources_tokens"]
+        tracing.note("prompt", report)
+        logger.debug(f"answer prompt tokens: {report}")
+
+        user_question_source = user_question + sources
         conversation = [
             {'role': 'system', 'content': system_message},
             {'role': 'user', 'content': user_question_source}
         ]
         return conversation
 
-    def RAG(self, query, chat_history=[]):
-        search_results = self.search(query)
+    # used_sources: optional list that receives the keys of the sources the
+    # answer was generated from; the caller marks them seen on the
+    # conversation if the answer is kept. prefetched: (topics, sources) from
+    # aretrieve for this same query, used instead of classifying and searching.
+    # use_cache=False bypasses the answer cache, e.g. for answers to made-up
+    # turns; with a cache_entry list the answer is not cached but (vector,
+    # topics) is appended for cache_answer once the caller keeps the answer
+    def RAG(self, query, chat_history=[], used_sources=None, prefetched=None, use_cache=True,
+            cache_entry=None):
+        topics = prefetched[0] if prefetched else self.search_topics(query)
+        vector = self.answer_context(query, chat_history) if use_cache else None
+        cached = self.cached_answer(vector, topics)
+        if cached is not None:
+            return cached
+        search_results = prefetched[1] if prefetched else self.topic_search(query, topics)
+        start = self.prompt_budget.history_start(chat_history)
+        history_summary = self.summary_agent.RAG(chat_history[:start])
         messages = self.generate_conversation(
-            query, search_results, chat_history)
+            query, search_results, chat_history, history_summary, used_sources, start)
         answer = self.send_messages(messages)
+        self._keep_answer(vector, topics, answer.content, cache_entry)
+        return answer.content
+
+    async def aRAG(self, query, chat_history=[], used_sources=None, prefetched=None, use_cache=True,
+                   cache_entry=None):
+        async def classify():
+            return prefetched[0] if prefetched else await tracing.to_thread(self.search_topics, query)
+
+        async def context():
+            return await tracing.to_thread(self.answer_context, query, chat_history) if use_cache else None
+
+        async def search():
+            return prefetched[1] if prefetched else await self.atopic_search(query, topics)
+
+        topics, vector = await asyncio.gather(classify(), context())
+        cached = self.cached_answer(vector, topics)
+        if cached is not None:
+            return cached
+
+        # Retrieval and folding old history into the summary are independent
+        start = self.prompt_budget.history_start(chat_history)
+        search_results, history_summary = await asyncio.gather(
+            search(), self.summary_agent.aRAG(chat_history[:start]))
+        messages = self.generate_conversation(
+            query, search_results, chat_history, history_summary, used_sources, start)
+        answer = await self.asend_messages(messages)
+        self._keep_answer(vector, topics, answer.content, cache_entry)
         return answer.content
 
+    def RAG_stream(self, query, chat_history=[], used_sources=None, prefetched=None):
+        topics = prefetched[0] if prefetched else self.search_topics(query)
+        vector = self.answer_context(query, chat_history)
+        cached = self.cached_answer(vector, topics)
+        if cached is not None:
+            yield cached
+            return
+        search_results = prefetched[1] if prefetched else self.topic_search(query, topics)
+        start = self.prompt_budget.history_start(chat_history)
+        history_summary = self.summary_agent.RAG(chat_history[:start])
+        messages = self.generate_conversation(
+            query, search_results, chat_history, history_summary, used_sources, start)
+        chunks = []
+        for chunk in self.send_messages(messages, stream=True):
+            chunks.append(chunk)
+            yield chunk
+        self.cache_answer(vector, topics, "".join(chunks))
+
 # --------- TEST Agents ------------
 
 
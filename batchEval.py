@@ -0,0 +1,182 @@
+"""Offline evaluation of Chat.complete over a JSONL file of scenarios.
+
+    python batchEval.py scenarios.jsonl --out results.jsonl --parallel 8
+    LLM_CACHE=eval.sqlite LLM_CACHE_MODE=replay python batchEval.py scenarios.jsonl --out replay.jsonl
+
+Each line of the scenario file is {"query": ...} with optional "id",
+"turns" (follow-ups after the opening query) and "replies" (scripted user
+replies, used in order before UserResponseAgent takes over). Scenarios are
+read as they are needed and run --parallel at a time.
+
+Every finished scenario is appended to --out as one JSON line holding each
+turn's reply, the question / mock answer / response / dummy response, the
+similarity score, the turn policy decision, latency and per-stage timings
+and tokens. The output file is the checkpoint: run the same command again
+and scenarios already in it are skipped, except those that failed.
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import localBackend
+
+
+# (id, scenario) for each line; id defaults to the line number
+def iter_scenarios(path):
+    with open(path, 'r', encoding='utf8') as file:
+        for number, line in enumerate(file, 1):
+            if line.strip():
+                scenario = json.loads(line)
+                yield str(scenario.get("id", f"line-{number}")), scenario
+
+
+# Ids of scenarios already completed in the output file; a line cut short
+# by an interrupted run is removed
+def completed_ids(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'rb+') as file:
+        data = file.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            file.truncate(end)
+    completed = set()
+    for line in data[:end].decode("utf8").splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record.get("error") is None:
+            completed.add(record["id"])
+        else:
+            completed.discard(record["id"])
+    return completed
+
+
+def turn_record(turn, message, result, latency):
+    reply, metas, exit, trace = result
+    question, mock_answer, response, dummy_response, similarity = metas or (None,) * 5
+    policy = next((note for note in trace.notes if note["name"] == "policy"), None)
+    return {
+        "turn": turn,
+        "user": message,
+        "reply": reply,
+        "exit": exit,
+        "question": question,
+        "mock_answer": mock_answer,
+        "response": response,
+        "dummy_response": dummy_response,
+        "similarity": similarity,
+        "decision": policy["decision"] if policy else None,
+        "latency": latency,
+        "prompt_tokens": sum(span.prompt_tokens or 0 for span in trace.spans),
+        "completion_tokens": sum(span.completion_tokens or 0 for span in trace.spans),
+        "stages": trace.stage_totals(),
+    }
+
+
+def run_scenario(scenario_id, scenario, turns):
+    import run
+    chat = run.Chat()
+    user = run.get_shared_agent("user_response")
+    replies = list(scenario.get("replies", []))
+    record = {"id": scenario_id, "query": scenario["query"], "turns": [], "error": None}
+    started = time.perf_counter()
+    message = scenario["query"]
+    history = []
+    try:
+        for turn in range(scenario.get("turns", turns) + 1):
+            start = time.perf_counter()
+            result = chat.complete(message)
+            record["turns"].append(turn_record(turn, message, result, time.perf_counter() - start))
+            reply, exit = result[0], result[2]
+            if exit or turn == scenario.get("turns", turns):
+                break
+            message = replies.pop(0) if replies else user.RAG(scenario["query"], reply, history)
+            history.append((reply, message))
+    except Exception as error:
+        logging.exception(f"scenario {scenario_id} failed")
+        record["error"] = f"{type(error).__name__}: {error}"
+    record["wall"] = time.perf_counter() - started
+    return record
+
+
+class ResultWriter:
+    def __init__(self, path):
+        self.path = path
+        self.records = []
+        self._lock = threading.Lock()
+
+    # One write per line, flushed to disk, so a completed scenario survives
+    # the process being killed
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock, open(self.path, 'a', encoding='utf8') as file:
+            file.write(line)
+            file.flush()
+            os.fsync(file.fileno())
+            self.records.append(record)
+
+
+def run_batch(path, out, parallel=4, turns=3, limit=None):
+    done = completed_ids(out)
+    writer = ResultWriter(out)
+    skipped = 0
+    with ThreadPoolExecutor(parallel, thread_name_prefix="batch-eval") as executor:
+        pending = set()
+        submitted = 0
+        for scenario_id, scenario in iter_scenarios(path):
+            if scenario_id in done:
+                skipped += 1
+                continue
+            if limit is not None and submitted >= limit:
+                break
+            # Read no further ahead than there are free workers
+            while len(pending) >= parallel:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    writer.write(future.result())
+            pending.add(executor.submit(run_scenario, scenario_id, scenario, turns))
+            submitted += 1
+        for future in pending:
+            writer.write(future.result())
+    return summarize(writer.records, skipped)
+
+
+def summarize(records, skipped=0):
+    turns = [turn for record in records for turn in record["turns"]]
+    latencies = [turn["latency"] for turn in turns]
+    similarities = [turn["similarity"] for turn in turns if turn["similarity"] is not None]
+    return {
+        "scenarios": len(records),
+        "skipped": skipped,
+        "failed": sum(1 for record in records if record["error"] is not None),
+        "turns": len(turns),
+        "p50": float(np.percentile(latencies, 50)) if latencies else None,
+        "p95": float(np.percentile(latencies, 95)) if latencies else None,
+        "similarity_mean": float(np.mean(similarities)) if similarities else None,
+        "tokens_per_turn": float(np.mean([turn["prompt_tokens"] + turn["completion_tokens"]
+                                          for turn in turns])) if turns else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenarios", help="JSONL of scenarios: {\"query\": ..., \"id\", \"turns\", \"replies\": optional}")
+    parser.add_argument("--out", required=True, help="JSONL results, appended to and resumed from")
+    parser.add_argument("--parallel", type=int, default=4, help="scenarios run at once")
+    parser.add_argument("--turns", type=int, default=3, help="follow-up turns per scenario")
+    parser.add_argument("--limit", type=int, help="run at most this many new scenarios")
+    parser.add_argument("--backend", choices=["local", "azure"], default="azure",
+                        help="azure unless CHATBOT_BACKEND=local is set")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    if args.backend == "local":
+        localBackend.enable()
+    summary = run_batch(args.scenarios, args.out, args.parallel, args.turns, args.limit)
+    print(json.dumps(summary, indent=2))
@@ -0,0 +1,136 @@
+"""Latency benchmark of Chat.complete against the local stand-in backends.
+
+    python benchmark.py --depths 1 3 5 --runs 10 --chat-latency 0.8 2.0
+
+Runs conversations of each depth (number of follow-up turns after the
+opening query) and reports p50/p95 per-turn latency and per-stage cost.
+No network access is needed.
+"""
+import argparse
+import json
+import os
+import time
+from collections import defaultdict
+import numpy as np
+
+os.environ["CHATBOT_BACKEND"] = "local"
+
+import localBackend  # noqa: E402
+from localBackend import LatencyModel  # noqa: E402
+
+OPENING_QUERY = "I recently rented an apartment in Hong Kong, and after moving in, I discovered that there is a severe mold problem. The landlord was aware of the issue but did not disclose it to me before signing the lease agreement. I'm concerned about my health and want to know if I have any legal rights in this situation."
+FOLLOW_UPS = [
+    "I told the landlord by email but they have not replied.",
+    "The lease was signed two months ago and I have photos of the mold.",
+    "I have been coughing since I moved in and saw a doctor last week.",
+    "The agreement does not mention anything about repairs.",
+    "I would like to move out and get my deposit back.",
+]
+
+
+def percentiles(values):
+    if not values:
+        return {"n": 0, "p50": None, "p95": None}
+    return {"n": len(values),
+            "p50": float(np.percentile(values, 50)),
+            "p95": float(np.percentile(values, 95))}
+
+
+def run_benchmark(depths, runs, warm=False):
+    import agents
+    import embeddingHelper
+    import run
+    import turnPolicy
+
+    stage_timings = defaultdict(list)
+    stage_queued = defaultdict(list)
+    turn_latencies = {depth: defaultdict(list) for depth in depths}
+    localBackend.SETTINGS.reset_stats()
+    answer_cache = run.get_answer_agent().answer_cache
+    for depth in depths:
+        for _ in range(runs):
+            if not warm:
+                agents.SEARCH_CACHE.clear()
+                embeddingHelper.EMBEDDING_CACHE.clear()
+                if answer_cache is not None:
+                    answer_cache.clear()
+            chat = run.Chat()
+            messages = [OPENING_QUERY] + [FOLLOW_UPS[turn % len(FOLLOW_UPS)] for turn in range(depth)]
+            for turn, message in enumerate(messages):
+                start = time.perf_counter()
+                trace = chat.complete(message)[3]
+                turn_latencies[depth][turn].append(time.perf_counter() - start)
+                for span in trace.spans:
+                    stage_timings[span.stage].append(span.wall)
+                    stage_queued[span.stage].append(span.queued)
+
+    return {
+        "turns": {depth: {turn: percentiles(values) for turn, values in by_turn.items()}
+                  for depth, by_turn in turn_latencies.items()},
+        "stages": {stage: percentiles(values) for stage, values in stage_timings.items()},
+        "stages_queued": {stage: percentiles(values) for stage, values in stage_queued.items()},
+        "backend_calls": dict(localBackend.SETTINGS.calls),
+        "backend_simulated_seconds": dict(localBackend.SETTINGS.simulated_seconds),
+        "answer_cache": answer_cache.stats() if answer_cache is not None else None,
+        "turn_policy": turnPolicy.STATS.stats(),
+    }
+
+
+def print_report(report):
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:9.1f}"
+
+    print(f"{'depth':>5} {'turn':>4} {'n':>4} {'p50 ms':>9} {'p95 ms':>9}")
+    for depth, by_turn in report["turns"].items():
+        for turn, stats in by_turn.items():
+            print(f"{depth:>5} {turn:>4} {stats['n']:>4} {ms(stats['p50'])} {ms(stats['p95'])}")
+    print()
+    print(f"{'stage':<16} {'n':>5} {'p50 ms':>9} {'p95 ms':>9} {'queued p95':>10}")
+    for stage, stats in report["stages"].items():
+        queued = report["stages_queued"][stage]
+        print(f"{stage:<16} {stats['n']:>5} {ms(stats['p50'])} {ms(stats['p95'])} {ms(queued['p95'])}")
+    print()
+    for kind, calls in report["backend_calls"].items():
+        print(f"{kind:<12} calls={calls:<6} simulated={report['backend_simulated_seconds'][kind]:.2f}s")
+    decisions = report["turn_policy"]["decisions"]
+    print("turn policy " + " ".join(f"{decision}={count}" for decision, count in decisions.items()) +
+          "  skipped " + (" ".join(f"{stage}={count}" for stage, count in
+                                   report["turn_policy"]["skipped_stages"].items()) or "nothing"))
+    if report["answer_cache"]:
+        cache = report["answer_cache"]
+        print(f"answer cache hit rate={cache['hit_rate']:.2f} hits={cache['hits']} "
+              f"mean hit age={cache['hit_age_mean']:.1f}s")
+
+
+def latency_arg(values, dist, seed):
+    median = values[0]
+    p95 = values[1] if len(values) > 1 else None
+    return LatencyModel(median, p95, dist=dist, seed=seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 3, 5])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--chat-latency", type=float, nargs="+", default=[0.05],
+                        metavar=("MEDIAN", "P95"), help="seconds")
+    parser.add_argument("--embedding-latency", type=float, nargs="+", default=[0.01], metavar=("MEDIAN", "P95"))
+    parser.add_argument("--search-latency", type=float, nargs="+", default=[0.02], metavar=("MEDIAN", "P95"))
+    parser.add_argument("--dist", choices=["lognormal", "uniform", "constant"], default="lognormal")
+    parser.add_argument("--responses", help="recorded responses JSON file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--warm", action="store_true", help="keep search/embedding/answer caches between runs")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    localBackend.configure(
+        chat_latency=latency_arg(args.chat_latency, args.dist, args.seed),
+        embedding_latency=latency_arg(args.embedding_latency, args.dist, args.seed + 1),
+        search_latency=latency_arg(args.search_latency, args.dist, args.seed + 2),
+        responses_file=args.responses,
+    )
+    report = run_benchmark(args.depths, args.runs, warm=args.warm)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf8') as file:
+            json.dump(report, file, indent=2)
@@ -0,0 +1,363 @@
+"""Process-wide Azure OpenAI / AI Search clients and request limits.
+
+Every agent, session and the embedding helper share one client per
+(endpoint, api version) or (endpoint, index), so a process keeps one HTTP
+connection pool per service rather than one per agent. Calls made through
+`call` / `acall` are additionally
+
+- limited per deployment by a token bucket for requests and tokens per
+  minute (OPENAI_RPM / OPENAI_TPM, 0 = unlimited) and a cap on concurrent
+  requests (OPENAI_MAX_CONCURRENCY),
+- retried on 429, 5xx, timeouts and connection errors with jittered
+  exponential backoff, waiting for Retry-After when the service sends it
+  (OPENAI_MAX_RETRIES).
+
+The openai clients' own retries are disabled so that every retry goes
+through the limiter.
+"""
+import asyncio
+import collections
+import logging
+import os
+import random
+import threading
+import time
+import localBackend
+import tracing
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+RETRY_ERRORS = ("APIConnectionError", "APITimeoutError", "ServiceRequestError", "ServiceResponseError")
+
+
+class TokenBucket:
+    """Refills `rate` units per minute up to `rate`; 0 means unlimited.
+
+    reserve() takes the units immediately, going negative if need be, and
+    returns how long the caller must wait before using them, so waiting can
+    be done with time.sleep or asyncio.sleep.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._level = float(rate)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._level = min(self.rate, self._level + (now - self._updated) * self.rate / 60)
+            self._updated = now
+            # A single request larger than the bucket waits for a full bucket
+            self._level -= min(amount, self.rate)
+            return 0.0 if self._level >= 0 else -self._level * 60 / self.rate
+
+
+class Slots:
+    """Counting semaphore shared by threads and coroutines on any event loop.
+
+    Waiters of either kind are served first in, first out; a released slot
+    is handed straight to the next waiter.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._used = 0
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._used < self.limit and not self._waiters:
+                self._used += 1
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+        event.wait()
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._used < self.limit and not self._waiters:
+                self._used += 1
+                return
+            waiter = loop.create_future()
+            self._waiters.append((loop, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = (loop, waiter) not in self._waiters
+                if not granted:
+                    self._waiters.remove((loop, waiter))
+            # A slot handed over before the cancellation is released again;
+            # one still on its way is released by _grant
+            if granted and waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def _grant(self, waiter):
+        if waiter.cancelled():
+            self.release()
+        else:
+            waiter.set_result(None)
+
+    def release(self):
+        with self._lock:
+            if not self._waiters:
+                self._used -= 1
+                return
+            waiter = self._waiters.popleft()
+        if isinstance(waiter, threading.Event):
+            waiter.set()
+        else:
+            loop, future = waiter
+            try:
+                loop.call_soon_threadsafe(self._grant, future)
+            except RuntimeError:
+                # The waiter's loop is closed
+                self.release()
+
+
+class DeploymentLimits:
+    def __init__(self, rpm=0, tpm=0, max_concurrency=16):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        # One cap for sync and async callers alike
+        self._slots = Slots(max_concurrency)
+
+    # Seconds to wait before sending a request estimated at `tokens` tokens
+    def reserve(self, tokens=0):
+        return max(self.requests.reserve(1), self.tokens.reserve(tokens))
+
+    # Count tokens only known after the response (e.g. completion tokens)
+    def charge(self, tokens):
+        if tokens:
+            self.tokens.reserve(tokens)
+
+    def acquire(self):
+        self._slots.acquire()
+
+    async def aacquire(self):
+        await self._slots.aacquire()
+
+    def release(self):
+        self._slots.release()
+
+
+def _status(error):
+    return getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+
+
+# Seconds the service asked us to wait, from Retry-After(-ms) headers
+def _retry_after(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class ClientRegistry:
+    def __init__(self, max_connections=None, max_retries=None, backoff_base=0.5, backoff_max=30.0):
+        self.max_connections = max_connections or int(os.environ.get("OPENAI_MAX_CONNECTIONS", "100"))
+        self.max_retries = max_retries if max_retries is not None else int(os.environ.get("OPENAI_MAX_RETRIES", "5"))
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self._clients = {}
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def _client(self, key, create):
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients[key] = create()
+        return client
+
+    def _http_limits(self):
+        import httpx
+        return httpx.Limits(max_connections=self.max_connections,
+                            max_keepalive_connections=self.max_connections)
+
+    def openai_client(self, api_version=None):
+        api_version = api_version or os.environ.get("AZURE_OPENAI_API_VERSION")
+        if localBackend.enabled():
+            return self._client(("local-openai",), localBackend.LocalOpenAIClient)
+
+        def create():
+            import httpx
+            from openai import AzureOpenAI
+            return AzureOpenAI(
+                azure_endpoint=os.environ.get("AZURE_OPENAI_ENDPOINT"),
+                api_key=os.environ.get("AZURE_OPENAI_KEY") or os.environ.get("AZURE_OPENAI_API_KEY"),
+                api_version=api_version,
+                max_retries=0,
+                http_client=httpx.Client(limits=self._http_limits()),
+            )
+        return self._client(("openai", os.environ.get("AZURE_OPENAI_ENDPOINT"), api_version), create)
+
+    def async_openai_client(self, api_version=None):
+        api_version = api_version or os.environ.get("AZURE_OPENAI_API_VERSION")
+        if localBackend.enabled():
+            return self._client(("local-async-openai",), localBackend.AsyncLocalOpenAIClient)
+
+        def create():
+            import httpx
+            from openai import AsyncAzureOpenAI
+            return AsyncAzureOpenAI(
+                azure_endpoint=os.environ.get("AZURE_OPENAI_ENDPOINT"),
+                api_key=os.environ.get("AZURE_OPENAI_KEY") or os.environ.get("AZURE_OPENAI_API_KEY"),
+                api_version=api_version,
+                max_retries=0,
+                http_client=httpx.AsyncClient(limits=self._http_limits()),
+            )
+        return self._client(("async-openai", os.environ.get("AZURE_OPENAI_ENDPOINT"), api_version), create)
+
+    def search_client(self, conf):
+        if localBackend.enabled():
+            return self._client(("local-search",), localBackend.LocalSearchClient)
+
+        def create():
+            from azure.core.credentials import AzureKeyCredential
+            from azure.search.documents import SearchClient
+            return SearchClient(
+                endpoint=conf.endpoint,
+                index_name=conf.index,
+                credential=AzureKeyCredential(conf.credential),
+            )
+        return self._client(("search", conf.endpoint, conf.index), create)
+
+    def async_search_client(self, conf):
+        if localBackend.enabled():
+            return self._client(("local-async-search",), localBackend.AsyncLocalSearchClient)
+
+        def create():
+            from azure.core.credentials import AzureKeyCredential
+            from azure.search.documents.aio import SearchClient as AsyncSearchClient
+            return AsyncSearchClient(
+                endpoint=conf.endpoint,
+                index_name=conf.index,
+                credential=AzureKeyCredential(conf.credential),
+            )
+        return self._client(("async-search", conf.endpoint, conf.index), create)
+
+    # Override the OPENAI_RPM / OPENAI_TPM / OPENAI_MAX_CONCURRENCY defaults
+    # for one deployment
+    def configure_deployment(self, deployment, rpm=0, tpm=0, max_concurrency=16):
+        with self._lock:
+            self._limits[deployment] = DeploymentLimits(rpm, tpm, max_concurrency)
+        return self._limits[deployment]
+
+    def limits(self, deployment):
+        with self._lock:
+            limits = self._limits.get(deployment)
+            if limits is None:
+                limits = self._limits[deployment] = DeploymentLimits(
+                    int(os.environ.get("OPENAI_RPM", "0")),
+                    int(os.environ.get("OPENAI_TPM", "0")),
+                    int(os.environ.get("OPENAI_MAX_CONCURRENCY", "16")))
+        return limits
+
+    # Seconds to wait before retrying after error, or None if it should not be retried
+    def _retry_delay(self, error, attempt):
+        status = _status(error)
+        if status == 429:
+            self.throttled += 1
+        if attempt >= self.max_retries or \
+                (status not in RETRY_STATUS and type(error).__name__ not in RETRY_ERRORS):
+            return None
+        self.retries += 1
+        delay = _retry_after(error)
+        if delay is None:
+            # Full jitter: uniform in [0, base * 2^attempt]
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        logger.warning(f"{type(error).__name__} (status {status}), retry {attempt + 1} in {delay:.2f}s")
+        tracing.note("retry", {"error": type(error).__name__, "status": status,
+                               "attempt": attempt + 1, "delay": delay})
+        return delay
+
+    # fn() under limits with retries; returns holding a concurrency slot
+    def _call_holding(self, limits, fn, tokens):
+        attempt = 0
+        while True:
+            waited = time.monotonic()
+            time.sleep(limits.reserve(tokens))
+            limits.acquire()
+            tracing.add_queued(time.monotonic() - waited)
+            self.requests += 1
+            try:
+                return fn()
+            except BaseException as error:
+                limits.release()
+                delay = self._retry_delay(error, attempt) if isinstance(error, Exception) else None
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+    # Run fn() under deployment's limits, retrying transient failures;
+    # tokens is the estimated request size in tokens
+    def call(self, deployment, fn, tokens=0):
+        limits = self.limits(deployment)
+        result = self._call_holding(limits, fn, tokens)
+        limits.release()
+        return result
+
+    # call for streamed responses: yields from the stream fn() returns and
+    # keeps its concurrency slot until the stream is exhausted or closed
+    def call_stream(self, deployment, fn, tokens=0):
+        limits = self.limits(deployment)
+        stream = self._call_holding(limits, fn, tokens)
+        try:
+            yield from stream
+        finally:
+            close = getattr(stream, "close", None)
+            try:
+                if close is not None:
+                    close()
+            finally:
+                limits.release()
+
+    # Coroutine twin of call; make_coro() returns a fresh coroutine per attempt
+    async def acall(self, deployment, make_coro, tokens=0):
+        limits = self.limits(deployment)
+        attempt = 0
+        while True:
+            waited = time.monotonic()
+            await asyncio.sleep(limits.reserve(tokens))
+            await limits.aacquire()
+            tracing.add_queued(time.monotonic() - waited)
+            self.requests += 1
+            try:
+                return await make_coro()
+            except Exception as error:
+                delay = self._retry_delay(error, attempt)
+                if delay is None:
+                    raise
+            finally:
+                limits.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def stats(self):
+        with self._lock:
+            clients = len(self._clients)
+        # throttled counts every 429 response, retried or not
+        return {"clients": clients, "requests": self.requests, "retries": self.retries,
+                "throttled": self.throttled}
+
+
+REGISTRY = ClientRegistry()
@@ -0,0 +1,85 @@
+import hashlib
+import os
+from cacheHelper import TTLCache
+from clientRegistry import REGISTRY
+from llmCache import get_llm_cache, cache_key
+from promptBudget import count_tokens
+import tracing
+
+# Azure OpenAI accepts at most 2048 inputs per embeddings request
+EMBEDDING_BATCH_SIZE = 2048
+
+# Content-hash keyed, shared by every session in the process. ~3072 floats
+# per entry for embedding-large, so the default cap stays around 100MB.
+EMBEDDING_CACHE = TTLCache(
+    maxsize=int(os.environ.get("EMBEDDING_CACHE_SIZE", "4096")),
+    ttl=None
+)
+
+# Shared client from the process-wide registry
+def get_embedding_client():
+    return REGISTRY.openai_client()
+
+
+def _cache_key(deployment, text):
+    return hashlib.sha256((str(deployment) + "\0" + text).encode("utf8")).hexdigest()
+
+
+# Embed texts with one request per batch of uncached texts; returns an
+# array of shape (len(texts), dim)
+def embed_texts(texts):
+    import numpy as np
+    deployment = os.environ.get("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
+    keys = [_cache_key(deployment, text) for text in texts]
+
+    vectors = {}
+    missing = {}
+    for key, text in zip(keys, texts):
+        vector = EMBEDDING_CACHE.get(key)
+        if vector is not None:
+            vectors[key] = vector
+        else:
+            missing.setdefault(key, text)
+
+    # Texts not in memory may still be in the persistent LLM cache
+    llm_cache = get_llm_cache()
+    disk_keys = {}
+    if missing and llm_cache is not None and llm_cache.enabled:
+        for key, text in list(missing.items()):
+            disk_keys[key] = cache_key("embedding", deployment=deployment, text=text)
+            value = llm_cache.get(disk_keys[key])
+            if value is not None:
+                vectors[key] = np.frombuffer(value, dtype=np.float32)
+                EMBEDDING_CACHE.put(key, vectors[key])
+                del missing[key]
+
+    missing_keys = list(missing)
+    with tracing.span("embedding") as span:
+        span.cache_hit = not missing_keys
+        for start in range(0, len(missing_keys), EMBEDDING_BATCH_SIZE):
+            batch = missing_keys[start:start + EMBEDDING_BATCH_SIZE]
+            inputs = [missing[key] for key in batch]
+            response = REGISTRY.call(
+                deployment,
+                lambda: get_embedding_client().embeddings.create(model=deployment, input=inputs),
+                tokens=sum(count_tokens(text) for text in inputs))
+            span.record_usage(response.usage)
+            for key, item in zip(batch, sorted(response.data, key=lambda d: d.index)):
+                vector = np.asarray(item.embedding, dtype=np.float32)
+                EMBEDDING_CACHE.put(key, vector)
+                vectors[key] = vector
+                if key in disk_keys:
+                    llm_cache.put(disk_keys[key], "embedding", vector.tobytes())
+
+    return np.stack([vectors[key] for key in keys])
+
+
+def normalize(matrix):
+    import numpy as np
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+# Cosine similarity matrix of shape (len(a), len(b))
+def cosine_similarity(a, b):
+    return normalize(a) @ normalize(b).T
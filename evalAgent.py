@@ -1,16 +1,58 @@
-import os
+import threading
 import dotenv
-import evaluate
-import numpy as np
-from openai import AzureOpenAI
+from embeddingHelper import embed_texts, cosine_similarity, normalize
+import tracing
 
 dotenv.load_dotenv()
 
+# EvalAgent method -> evaluate metric name
+METRIC_NAMES = {"rouge": "rouge", "bleu": "bleu", "BERTScore": "bertscore"}
+
+# Loaded metrics, one instance per process
+_metrics = {}
+_metric_locks = {}
+_registry_lock = threading.Lock()
+
+
+def load_metric(name):
+    with _registry_lock:
+        lock = _metric_locks.setdefault(name, threading.Lock())
+    # Per-metric lock so a slow BERTScore load doesn't block ROUGE
+    with lock:
+        if name not in _metrics:
+            # Imported here: evaluate pulls in datasets/pandas, ~1s at startup
+            import evaluate
+            _metrics[name] = evaluate.load(name)
+    return _metrics[name]
+
+
+# Load metrics ahead of the first comparison; with background=True the
+# loading happens in a daemon thread which is returned
+def preload_metrics(names=METRIC_NAMES.values(), background=True):
+    names = list(names)
+    if not background:
+        for name in names:
+            load_metric(name)
+        return None
+    thread = threading.Thread(
+        target=lambda: [load_metric(name) for name in names], daemon=True)
+    thread.start()
+    return thread
+
+
 class EvalAgent:
-    def __init__(self, method = "opanAIEmbedding"):
+    def __init__(self, method = "opanAIEmbedding", batch_size = 64, num_threads = None, preload = False):
         self._method = method
+        self._batch_size = batch_size
+        self._num_threads = num_threads
+        if preload and method in METRIC_NAMES:
+            preload_metrics([METRIC_NAMES[method]])
 
     def evaluvate(self, prediction, reference):
+        with tracing.span("evaluate"):
+            return self._evaluate(prediction, reference)
+
+    def _evaluate(self, prediction, reference):
         if self._method == "rouge":
             return self.evalROUGE(prediction, reference)
         elif self._method == "bleu":
@@ -20,34 +62,60 @@ class EvalAgent:
         elif self._method == "OpenAIEmbedding":
             return self.evalOpenAIEmbedding(prediction, reference)
     
+    # Score many (prediction, reference) pairs with a single compute call.
+    # ROUGE and BERTScore return per-pair scores; BLEU is a corpus metric and
+    # returns one score over all pairs.
+    def evaluate_batch(self, predictions, references):
+        predictions, references = list(predictions), list(references)
+        if self._method == "rouge":
+            return load_metric('rouge').compute(
+                predictions=predictions, references=references, use_aggregator=False)
+        elif self._method == "bleu":
+            return load_metric('bleu').compute(
+                predictions=predictions, references=references)
+        elif self._method == "BERTScore":
+            return self._compute_bertscore(predictions, references)
+        elif self._method == "OpenAIEmbedding":
+            return self.evaluate_pairs(predictions, references).tolist()
+
+    def _compute_bertscore(self, predictions, references):
+        if self._num_threads:
+            import torch
+            torch.set_num_threads(self._num_threads)
+        return load_metric('bertscore').compute(
+            predictions=predictions, references=references, lang='en',
+            batch_size=self._batch_size, nthreads=self._num_threads or 4)
+
     def evalROUGE(self, prediction, reference):
-        rouge = evaluate.load('rouge')
+        rouge = load_metric('rouge')
         results = rouge.compute(predictions=[prediction], references=[reference])
         return results
     
     def evalBLEU(self, prediction, reference):
-        bleu = evaluate.load('bleu')
+        bleu = load_metric('bleu')
         results = bleu.compute(predictions=[prediction], references=[reference])
         return results
     
     def evalBERTScore(self, prediction, reference):
-        bert = evaluate.load('bertscore')
-        results = bert.compute(predictions=[prediction], references=[reference], lang='en')
-        return results
+        return self._compute_bertscore([prediction], [reference])
     
     def evalOpenAIEmbedding(self, prediction, references):
-        client = AzureOpenAI(
-            api_version = os.environ.get("AZURE_OPENAI_API_VERSION"),
-        )
-        prediction_embedding = client.embeddings.create(
-            model = os.environ.get("AZURE_OPENAI_EMBEDDING_DEPLOYMENT"),
-            input = prediction,
-        ).data[0].embedding
-        references_embedding = client.embeddings.create(
-            model = os.environ.get("AZURE_OPENAI_EMBEDDING_DEPLOYMENT"),
-            input = references,
-        ).data[0].embedding
-        return np.dot(prediction_embedding, references_embedding)
+        # Both texts go out in one batched request
+        embeddings = embed_texts([prediction, references])
+        return float(cosine_similarity(embeddings[:1], embeddings[1:])[0, 0])
+
+    # Cosine similarity of every prediction against every reference, as a
+    # (len(predictions), len(references)) matrix
+    def evaluate_many(self, predictions, references):
+        embeddings = embed_texts(list(predictions) + list(references))
+        return cosine_similarity(embeddings[:len(predictions)], embeddings[len(predictions):])
+
+    # Cosine similarity of each prediction with its own reference, without
+    # building the full matrix of evaluate_many
+    def evaluate_pairs(self, predictions, references):
+        import numpy as np
+        embeddings = normalize(embed_texts(list(predictions) + list(references)))
+        return np.einsum("ij,ij->i", embeddings[:len(predictions)], embeddings[len(predictions):])
 
 
 
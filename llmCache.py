@@ -0,0 +1,148 @@
+"""Persistent cache of chat completions and embeddings.
+
+Set LLM_CACHE=<path to a SQLite file> to put it in front of
+Agent.send_messages / asend_messages and embeddingHelper.embed_texts.
+LLM_CACHE_MODE selects how it is used:
+
+    record       serve hits from the cache, call Azure on a miss and store
+                 the result (default)
+    replay       serve hits only; a miss raises CacheMiss instead of calling
+                 Azure, so a run is exactly reproducible
+    passthrough  ignore the cache
+
+Chat entries are keyed on (deployment, messages, temperature, n), embedding
+entries on (deployment, text). When the stored values exceed
+LLM_CACHE_MAX_MB the least recently used entries are deleted.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+MODES = ("record", "replay", "passthrough")
+
+
+class CacheMiss(LookupError):
+    pass
+
+
+def cache_key(kind, **params):
+    canonical = json.dumps({"kind": kind, **params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf8")).hexdigest()
+
+
+class LLMCache:
+    def __init__(self, path, mode="record", max_bytes=1024 * 1024 * 1024):
+        if mode not in MODES:
+            raise ValueError(f"unknown LLM cache mode {mode!r}, expected one of {MODES}")
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY, kind TEXT, value BLOB, size INTEGER, created REAL, accessed REAL)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    @property
+    def enabled(self):
+        return self.mode != "passthrough"
+
+    # Stored bytes for key, or None; in replay mode a miss raises CacheMiss
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self._db.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                self._db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+                return row[0]
+            self.misses += 1
+        if self.mode == "replay":
+            raise CacheMiss(f"no cached response for {key} in {self.path}")
+        return None
+
+    def put(self, key, kind, value):
+        if self.mode != "record":
+            return
+        now = time.time()
+        with self._lock:
+            old = self._db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                             (key, kind, value, len(value), now, now))
+            self._size += len(value) - (old[0] if old else 0)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Caller must hold self._lock; trims to 90% so eviction is not run on every put
+        target = self.max_bytes * 0.9
+        rows = self._db.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self._size <= target:
+                break
+            evicted.append((key,))
+            self._size -= size
+        self._db.executemany("DELETE FROM entries WHERE key = ?", evicted)
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM entries")
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "mode": self.mode,
+            "entries": entries,
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+# Shared cache configured from LLM_CACHE / LLM_CACHE_MODE / LLM_CACHE_MAX_MB,
+# or None when LLM_CACHE is not set
+def get_llm_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None and os.environ.get("LLM_CACHE"):
+            _cache = LLMCache(
+                os.environ["LLM_CACHE"],
+                mode=os.environ.get("LLM_CACHE_MODE", "record"),
+                max_bytes=int(float(os.environ.get("LLM_CACHE_MAX_MB", "1024")) * 1024 * 1024),
+            )
+    return _cache
+
+
+# Replace the shared cache, e.g. to switch an evaluation run to replay
+def set_llm_cache(cache):
+    global _cache
+    with _cache_lock:
+        _cache = cache
+    return cache
@@ -0,0 +1,238 @@
+"""Load test of Chat.complete with simulated users.
+
+    python loadTest.py --concurrency 8 --duration 60 --chat-latency 0.8 2.0
+    python loadTest.py --rate 0.5 --duration 120 --chat-capacity 16
+    python loadTest.py --concurrency 1 2 4 8 16 32 --duration 30   # find saturation
+
+Each simulated conversation opens with a seed scenario and then answers every
+reply with UserResponseAgent, for up to --turns follow-ups. With
+--concurrency, that many users run conversations back to back (closed loop);
+with --rate, new conversations arrive as a Poisson process at that many per
+second (open loop). Each level reports throughput, p50/p95/p99 turn latency,
+error and 429 rates and tokens per turn. Simulated user replies are not
+timed, but their calls do count against the backend.
+
+Runs against the local stand-in backends unless --backend azure is given;
+--chat-capacity makes the local chat endpoint answer 429 beyond that many
+concurrent requests.
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import localBackend
+from localBackend import LatencyModel
+
+SCENARIOS = [
+    {"query": "I recently rented an apartment in Hong Kong, and after moving in, I discovered that there is a severe mold problem. The landlord was aware of the issue but did not disclose it to me before signing the lease agreement. I'm concerned about my health and want to know if I have any legal rights in this situation."},
+    {"query": "My employer dismissed me last week without giving any reason after I had worked there for three years. Can I claim compensation?"},
+    {"query": "I slipped on a wet floor in a shopping mall and broke my wrist. Who is responsible for my medical costs?"},
+    {"query": "A shop refused to refund a faulty phone I bought two days ago. What can I do?"},
+    {"query": "I cannot afford a lawyer for my divorce. Am I eligible for legal aid?"},
+]
+
+
+def read_scenarios(path):
+    with open(path, 'r', encoding='utf8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+class LoadResults:
+    def __init__(self):
+        self.latencies = []
+        self.tokens = []
+        self.errors = {}
+        self.user_errors = 0
+        self.conversations = 0
+        self._lock = threading.Lock()
+
+    def record_turn(self, latency, trace):
+        tokens = sum((span.prompt_tokens or 0) + (span.completion_tokens or 0) for span in trace.spans)
+        with self._lock:
+            self.latencies.append(latency)
+            self.tokens.append(tokens)
+
+    def record_error(self, error):
+        with self._lock:
+            name = type(error).__name__
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def record_user_error(self):
+        with self._lock:
+            self.user_errors += 1
+
+    def record_conversation(self):
+        with self._lock:
+            self.conversations += 1
+
+
+def run_conversation(scenario, turns, deadline, results):
+    import run
+    chat = run.Chat()
+    user = run.get_shared_agent("user_response")
+    history = []
+    message = scenario["query"]
+    results.record_conversation()
+    for _ in range(scenario.get("turns", turns) + 1):
+        if time.monotonic() >= deadline:
+            return
+        start = time.perf_counter()
+        try:
+            reply, _, exit, trace = chat.complete(message)
+        except Exception as error:
+            results.record_error(error)
+            return
+        results.record_turn(time.perf_counter() - start, trace)
+        if exit:
+            return
+        try:
+            message = user.RAG(scenario["query"], reply, history)
+        except Exception:
+            results.record_user_error()
+            return
+        history.append((reply, message))
+
+
+def closed_loop(scenarios, concurrency, turns, duration, seed):
+    results = LoadResults()
+    deadline = time.monotonic() + duration
+
+    def user(index):
+        rng = random.Random(seed + index)
+        while time.monotonic() < deadline:
+            run_conversation(rng.choice(scenarios), turns, deadline, results)
+
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="load-user") as executor:
+        for future in [executor.submit(user, index) for index in range(concurrency)]:
+            future.result()
+    return results
+
+
+def open_loop(scenarios, rate, turns, duration, seed, max_users):
+    results = LoadResults()
+    rng = random.Random(seed)
+    start = time.monotonic()
+    deadline = start + duration
+    with ThreadPoolExecutor(max_users, thread_name_prefix="load-user") as executor:
+        futures = []
+        arrival = start
+        while True:
+            arrival += rng.expovariate(rate)
+            if arrival >= deadline:
+                break
+            time.sleep(max(0.0, arrival - time.monotonic()))
+            futures.append(executor.submit(run_conversation, rng.choice(scenarios), turns, deadline, results))
+        for future in futures:
+            future.result()
+    return results
+
+
+def run_level(scenarios, turns, duration, seed, concurrency=None, rate=None, max_users=256):
+    from clientRegistry import REGISTRY
+    before = REGISTRY.stats()
+    started = time.perf_counter()
+    if rate:
+        results = open_loop(scenarios, rate, turns, duration, seed, max_users)
+    else:
+        results = closed_loop(scenarios, concurrency, turns, duration, seed)
+    elapsed = time.perf_counter() - started
+    after = REGISTRY.stats()
+
+    turns_ok = len(results.latencies)
+    failed = sum(results.errors.values())
+    requests = after["requests"] - before["requests"]
+    latencies = np.array(results.latencies) if results.latencies else None
+    return {
+        "concurrency": concurrency,
+        "rate": rate,
+        "elapsed": elapsed,
+        "conversations": results.conversations,
+        "turns": turns_ok,
+        "throughput": turns_ok / elapsed if elapsed else 0.0,
+        "p50": float(np.percentile(latencies, 50)) if latencies is not None else None,
+        "p95": float(np.percentile(latencies, 95)) if latencies is not None else None,
+        "p99": float(np.percentile(latencies, 99)) if latencies is not None else None,
+        "error_rate": failed / (turns_ok + failed) if turns_ok + failed else 0.0,
+        "errors": results.errors,
+        "user_errors": results.user_errors,
+        "requests": requests,
+        "rate_429": (after["throttled"] - before["throttled"]) / requests if requests else 0.0,
+        "tokens_per_turn": float(np.mean(results.tokens)) if results.tokens else 0.0,
+    }
+
+
+def print_report(levels):
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:8.0f}"
+
+    print(f"{'users':>5} {'rate/s':>6} {'convs':>5} {'turns':>5} {'turns/s':>7} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'err %':>6} {'429 %':>6} {'tok/turn':>8}")
+    for level in levels:
+        print(f"{level['concurrency'] or '-':>5} {level['rate'] or '-':>6} {level['conversations']:>5} "
+              f"{level['turns']:>5} {level['throughput']:7.2f} {ms(level['p50'])} {ms(level['p95'])} "
+              f"{ms(level['p99'])} {level['error_rate'] * 100:6.1f} {level['rate_429'] * 100:6.1f} "
+              f"{level['tokens_per_turn']:8.0f}")
+    for level in levels:
+        if level["errors"]:
+            print(f"errors at {level['concurrency'] or level['rate']}: {level['errors']}")
+
+
+def latency_arg(values, dist, seed):
+    median = values[0]
+    p95 = values[1] if len(values) > 1 else None
+    return LatencyModel(median, p95, dist=dist, seed=seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--concurrency", type=int, nargs="+", default=[4],
+                      help="closed-loop simulated users; several values run one level each")
+    load.add_argument("--rate", type=float, nargs="+", help="open-loop conversation arrivals per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per level")
+    parser.add_argument("--turns", type=int, default=3, help="follow-up turns per conversation")
+    parser.add_argument("--scenarios", help="JSONL of seed scenarios: {\"query\": ..., \"turns\": optional}")
+    parser.add_argument("--max-users", type=int, default=256, help="open-loop cap on concurrent conversations")
+    parser.add_argument("--backend", choices=["local", "azure"], default="local")
+    parser.add_argument("--chat-latency", type=float, nargs="+", default=[0.8, 2.0],
+                        metavar=("MEDIAN", "P95"), help="seconds")
+    parser.add_argument("--embedding-latency", type=float, nargs="+", default=[0.05], metavar=("MEDIAN", "P95"))
+    parser.add_argument("--search-latency", type=float, nargs="+", default=[0.15], metavar=("MEDIAN", "P95"))
+    parser.add_argument("--dist", choices=["lognormal", "uniform", "constant"], default="lognormal")
+    parser.add_argument("--chat-capacity", type=int, default=0,
+                        help="local chat requests in flight before answering 429 (0 = unlimited)")
+    parser.add_argument("--responses", help="recorded responses JSON file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    # Retries are expected under load and counted in the report
+    logging.basicConfig(level=logging.ERROR)
+    if args.backend == "local":
+        localBackend.enable()
+        localBackend.configure(
+            chat_latency=latency_arg(args.chat_latency, args.dist, args.seed),
+            embedding_latency=latency_arg(args.embedding_latency, args.dist, args.seed + 1),
+            search_latency=latency_arg(args.search_latency, args.dist, args.seed + 2),
+            responses_file=args.responses,
+            chat_capacity=args.chat_capacity,
+        )
+    scenarios = read_scenarios(args.scenarios) if args.scenarios else SCENARIOS
+
+    levels = []
+    for value in args.rate or args.concurrency:
+        level = run_level(scenarios, args.turns, args.duration, args.seed,
+                          concurrency=None if args.rate else value, rate=value if args.rate else None,
+                          max_users=args.max_users)
+        levels.append(level)
+        print_report(levels[-1:])
+    if len(levels) > 1:
+        print()
+        print_report(levels)
+    if args.json:
+        with open(args.json, 'w', encoding='utf8') as file:
+            json.dump(levels, file, indent=2)
@@ -0,0 +1,395 @@
+"""Offline stand-ins for Azure OpenAI and Azure AI Search.
+
+Set CHATBOT_BACKEND=local (or call `enable()` before any agent is built) and
+every agent gets a local chat/embeddings client and search client instead of
+the Azure ones. Latencies are drawn from configurable distributions and the
+responses come from canned text or from a recorded responses file, so the
+whole pipeline can be exercised and timed without network access.
+
+With a chat capacity set, chat requests beyond that many in flight fail
+with LocalRateLimitError (HTTP 429 with Retry-After), like a deployment
+running out of quota.
+
+Recorded responses file (JSON):
+    {
+        "chat": {"<messages_key(messages)>": "response text", ...},
+        "documents": [{"id": ..., "title": ..., "content": ..., "topic": ...}, ...]
+    }
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+
+EMBEDDING_DIM = 256
+
+CANNED_CHAT = [
+    "Did you raise the problem with the other party in writing, and do you have a copy of that correspondence?",
+    "When did this happen, and have you signed any agreement or received any document about it?",
+    "Yes, I told them by email last month but they have not replied.",
+    "Under Hong Kong law you may be entitled to compensation. Keep written records of all communication, and consider seeking advice from the Legal Aid Department if you cannot afford a lawyer.",
+    "The landlord has a duty to keep the premises in a reasonable state of repair. If the defect was concealed before signing, you may be able to terminate the tenancy and claim damages.",
+]
+
+CANNED_DOCUMENTS = [
+    {"id": "1", "topic": "landlordTenant", "title": "1. Repairs and maintenance of rented premises",
+     "content": "The landlord is responsible for repairing structural defects and keeping the premises fit for habitation, unless the tenancy agreement provides otherwise."},
+    {"id": "2", "topic": "landlordTenant", "title": "2. Termination of a tenancy",
+     "content": "A tenant may terminate the tenancy early if the landlord breaches a fundamental term, such as failing to disclose a serious defect in the premises."},
+    {"id": "3", "topic": "employmentDisputes", "title": "1. Unreasonable dismissal",
+     "content": "An employee dismissed without a valid reason may claim remedies under the Employment Ordinance, including reinstatement or compensation."},
+    {"id": "4", "topic": "legalAid", "title": "1. Eligibility for legal aid",
+     "content": "Legal aid is available to applicants who pass the means test and the merits test administered by the Legal Aid Department."},
+    {"id": "5", "topic": "personalInjuries", "title": "1. Claiming compensation for personal injuries",
+     "content": "A person injured through the negligence of another may bring a claim for damages within three years of the injury."},
+    {"id": "6", "topic": "consumerComplaints", "title": "1. Making a consumer complaint",
+     "content": "Consumers may lodge complaints with the Consumer Council, which can mediate disputes between consumers and traders."},
+]
+
+
+class LatencyModel:
+    """Latency distribution in seconds.
+
+    dist is "constant", "uniform" (between 0 and 2 * median) or "lognormal"
+    (with the given median and 95th percentile).
+    """
+
+    def __init__(self, median=0.0, p95=None, dist="lognormal", seed=None):
+        self.median = median
+        self.p95 = p95 if p95 is not None else median * 2
+        self.dist = dist
+        self._random = random.Random(seed)
+
+    def sample(self):
+        if self.median <= 0:
+            return 0.0
+        if self.dist == "constant":
+            return self.median
+        if self.dist == "uniform":
+            return self._random.uniform(0, 2 * self.median)
+        sigma = max(math.log(self.p95 / self.median) / 1.645, 1e-6)
+        return self._random.lognormvariate(math.log(self.median), sigma)
+
+
+class _Response:
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = headers
+
+
+class LocalRateLimitError(Exception):
+    """Shaped like openai.RateLimitError for clientRegistry's retry logic."""
+    status_code = 429
+
+    def __init__(self, retry_after):
+        super().__init__(f"local chat capacity exceeded, retry after {retry_after:.3f}s")
+        self.response = _Response(429, {"retry-after-ms": str(int(retry_after * 1000))})
+
+
+class BackendSettings:
+    def __init__(self):
+        self.chat_latency = LatencyModel(0.0)
+        self.embedding_latency = LatencyModel(0.0)
+        self.search_latency = LatencyModel(0.0)
+        self.chat_responses = {}
+        self.documents = list(CANNED_DOCUMENTS)
+        # Concurrent chat requests served before answering 429; 0 = unlimited
+        self.chat_capacity = 0
+        self.calls = {"chat": 0, "embeddings": 0, "search": 0}
+        self.simulated_seconds = {"chat": 0.0, "embeddings": 0.0, "search": 0.0}
+        self.rejected = 0
+        self._chat_inflight = 0
+        self._lock = threading.Lock()
+
+    # Take a chat slot or raise LocalRateLimitError
+    def admit_chat(self):
+        with self._lock:
+            if self.chat_capacity and self._chat_inflight >= self.chat_capacity:
+                self.rejected += 1
+                raise LocalRateLimitError(max(self.chat_latency.median, 0.05))
+            self._chat_inflight += 1
+
+    def release_chat(self):
+        with self._lock:
+            self._chat_inflight -= 1
+
+    def draw(self, kind, model):
+        delay = model.sample()
+        with self._lock:
+            self.calls[kind] += 1
+            self.simulated_seconds[kind] += delay
+        return delay
+
+    def reset_stats(self):
+        with self._lock:
+            for kind in self.calls:
+                self.calls[kind] = 0
+                self.simulated_seconds[kind] = 0.0
+            self.rejected = 0
+
+
+SETTINGS = BackendSettings()
+_enabled = os.environ.get("CHATBOT_BACKEND", "azure") == "local"
+
+
+def enabled():
+    return _enabled
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def configure(chat_latency=None, embedding_latency=None, search_latency=None, responses_file=None,
+              chat_capacity=None):
+    if chat_capacity is not None:
+        SETTINGS.chat_capacity = chat_capacity
+    if chat_latency is not None:
+        SETTINGS.chat_latency = chat_latency
+    if embedding_latency is not None:
+        SETTINGS.embedding_latency = embedding_latency
+    if search_latency is not None:
+        SETTINGS.search_latency = search_latency
+    if responses_file is not None:
+        with open(responses_file, 'r', encoding='utf8') as file:
+            recorded = json.load(file)
+        SETTINGS.chat_responses = recorded.get("chat", {})
+        SETTINGS.documents = recorded.get("documents", SETTINGS.documents)
+
+
+def messages_key(messages):
+    canonical = json.dumps(messages, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf8")).hexdigest()
+
+
+def _tokens(text):
+    return re.findall(r"\w+", text.lower())
+
+
+def _count_tokens(messages):
+    return sum(len(_tokens(message["content"])) for message in messages)
+
+
+def chat_response_text(messages):
+    key = messages_key(messages)
+    if key in SETTINGS.chat_responses:
+        return SETTINGS.chat_responses[key]
+    return CANNED_CHAT[int(key, 16) % len(CANNED_CHAT)]
+
+
+def _completion(model, messages):
+    from openai.types.chat import ChatCompletion
+    text = chat_response_text(messages)
+    prompt_tokens = _count_tokens(messages)
+    completion_tokens = len(_tokens(text))
+    return ChatCompletion.model_validate({
+        "id": "local-" + messages_key(messages)[:12],
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model or "local",
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": text}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    })
+
+
+def _chunk(completion, content):
+    from openai.types.chat import ChatCompletionChunk
+    return ChatCompletionChunk.model_validate({
+        "id": completion.id,
+        "object": "chat.completion.chunk",
+        "created": completion.created,
+        "model": completion.model,
+        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}],
+    })
+
+
+def _split_stream(text):
+    return re.findall(r"\S+\s*", text) or [text]
+
+
+# Feature-hashed bag of words, so texts sharing words get similar vectors
+def embed(text):
+    import numpy as np
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    for token in _tokens(text):
+        index = int(hashlib.md5(token.encode("utf8")).hexdigest(), 16) % EMBEDDING_DIM
+        vector[index] += 1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _embedding_response(model, input):
+    from openai.types import CreateEmbeddingResponse
+    texts = [input] if isinstance(input, str) else list(input)
+    return CreateEmbeddingResponse.model_validate({
+        "object": "list",
+        "model": model or "local",
+        "data": [{"object": "embedding", "index": index, "embedding": embed(text).tolist()}
+                 for index, text in enumerate(texts)],
+        "usage": {"prompt_tokens": sum(len(_tokens(text)) for text in texts),
+                  "total_tokens": sum(len(_tokens(text)) for text in texts)},
+    })
+
+
+class _Namespace:
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+class LocalOpenAIClient:
+    """Drop-in for the parts of AzureOpenAI the agents use."""
+
+    def __init__(self):
+        self.chat = _Namespace(completions=_Namespace(create=self._create_chat))
+        self.embeddings = _Namespace(create=self._create_embeddings)
+
+    def _create_chat(self, model=None, messages=(), stream=False, **kwargs):
+        SETTINGS.admit_chat()
+        delay = SETTINGS.draw("chat", SETTINGS.chat_latency)
+        completion = _completion(model, messages)
+        if not stream:
+            try:
+                time.sleep(delay)
+            finally:
+                SETTINGS.release_chat()
+            return completion
+        return self._stream(completion, delay)
+
+    def _stream(self, completion, delay):
+        pieces = _split_stream(completion.choices[0].message.content)
+        try:
+            for piece in pieces:
+                time.sleep(delay / len(pieces))
+                yield _chunk(completion, piece)
+        finally:
+            SETTINGS.release_chat()
+
+    def _create_embeddings(self, model=None, input=(), **kwargs):
+        time.sleep(SETTINGS.draw("embeddings", SETTINGS.embedding_latency))
+        return _embedding_response(model, input)
+
+
+class AsyncLocalOpenAIClient:
+    """Drop-in for the parts of AsyncAzureOpenAI the agents use."""
+
+    def __init__(self):
+        self.chat = _Namespace(completions=_Namespace(create=self._create_chat))
+        self.embeddings = _Namespace(create=self._create_embeddings)
+
+    async def _create_chat(self, model=None, messages=(), stream=False, **kwargs):
+        SETTINGS.admit_chat()
+        delay = SETTINGS.draw("chat", SETTINGS.chat_latency)
+        completion = _completion(model, messages)
+        if not stream:
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                SETTINGS.release_chat()
+            return completion
+        return self._stream(completion, delay)
+
+    async def _stream(self, completion, delay):
+        pieces = _split_stream(completion.choices[0].message.content)
+        try:
+            for piece in pieces:
+                await asyncio.sleep(delay / len(pieces))
+                yield _chunk(completion, piece)
+        finally:
+            SETTINGS.release_chat()
+
+    async def _create_embeddings(self, model=None, input=(), **kwargs):
+        await asyncio.sleep(SETTINGS.draw("embeddings", SETTINGS.embedding_latency))
+        return _embedding_response(model, input)
+
+
+def _parse_topics(filter):
+    # Inverse of the "search.in(topic, 'a|b' , '|')" filter built by Agent.search
+    if not filter:
+        return None
+    match = re.search(r"search\.in\(topic,\s*'([^']*)'", filter)
+    return set(match.group(1).split("|")) if match else None
+
+
+def search_documents(search_text, top=5, filter=None):
+    topics = _parse_topics(filter)
+    query_tokens = set(_tokens(search_text or ""))
+    scored = []
+    for document in SETTINGS.documents:
+        if topics is not None and document.get("topic") not in topics:
+            continue
+        overlap = len(query_tokens & set(_tokens(document["title"] + " " + document["content"])))
+        scored.append((overlap, document))
+    scored.sort(key=lambda item: item[0], reverse=True)
+    results = []
+    for score, document in scored[:top]:
+        result = dict(document)
+        result["@search.score"] = float(score)
+        result["@search.reranker_score"] = float(score)
+        # Extractive caption: the document's first sentence
+        result["@search.captions"] = [_Namespace(text=re.split(r"(?<=[.!?])\s", document["content"])[0],
+                                                 highlights=None)]
+        results.append(result)
+    return results
+
+
+# Extractive answer: the top result's caption, if it matched at all
+def _answers(results):
+    if not results or not results[0]["@search.score"]:
+        return []
+    top = results[0]
+    return [_Namespace(key=top.get("id"), text=top["@search.captions"][0].text,
+                       score=top["@search.score"], highlights=None)]
+
+
+class _Results:
+    def __init__(self, results):
+        self._answers = _answers(results)
+        self._results = iter(results)
+
+    def __iter__(self):
+        return self._results
+
+    def get_answers(self):
+        return self._answers
+
+
+class LocalSearchClient:
+    """Drop-in for azure.search.documents.SearchClient.search."""
+
+    def search(self, search_text=None, top=5, filter=None, **kwargs):
+        time.sleep(SETTINGS.draw("search", SETTINGS.search_latency))
+        return _Results(search_documents(search_text, top, filter))
+
+
+class _AsyncResults:
+    def __init__(self, results):
+        self._answers = _answers(results)
+        self._results = iter(results)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._results)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def get_answers(self):
+        return self._answers
+
+
+class AsyncLocalSearchClient:
+    """Drop-in for azure.search.documents.aio.SearchClient.search."""
+
+    async def search(self, search_text=None, top=5, filter=None, **kwargs):
+        await asyncio.sleep(SETTINGS.draw("search", SETTINGS.search_latency))
+        return _AsyncResults(search_documents(search_text, top, filter))
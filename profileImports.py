@@ -0,0 +1,49 @@
+"""Import-time profile of a module, from `python -X importtime`.
+
+    python profileImports.py                    # profile `import run`
+    python profileImports.py --module ui --top 30
+    python profileImports.py --max-ms 500       # exit 1 if the import takes longer
+
+Runs the import in a fresh interpreter so nothing is already cached, and
+prints the slowest modules by cumulative time.
+"""
+import argparse
+import re
+import subprocess
+import sys
+
+_LINE_RE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+# [(module, self_us, cumulative_us, depth)] in the order imports finished
+def profile(module):
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                               capture_output=True, text=True)
+    if completed.returncode != 0:
+        sys.stderr.write(completed.stderr)
+        raise SystemExit(completed.returncode)
+    rows = []
+    for line in completed.stderr.splitlines():
+        match = _LINE_RE.match(line)
+        if match:
+            rows.append((match.group(4), int(match.group(1)), int(match.group(2)),
+                         (len(match.group(3)) - 1) // 2))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="run")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--max-ms", type=float, help="fail if the whole import takes longer")
+    args = parser.parse_args()
+
+    rows = profile(args.module)
+    total_ms = next((cumulative for name, _, cumulative, _ in rows if name == args.module), 0) / 1000
+    print(f"import {args.module}: {total_ms:.1f} ms")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for name, self_us, cumulative_us, depth in sorted(rows, key=lambda row: row[2], reverse=True)[:args.top]:
+        print(f"{cumulative_us / 1000:14.1f} {self_us / 1000:9.1f}  {'  ' * depth}{name}")
+    if args.max_ms is not None and total_ms > args.max_ms:
+        print(f"import {args.module} exceeds {args.max_ms:.0f} ms", file=sys.stderr)
+        raise SystemExit(1)
@@ -0,0 +1,136 @@
+"""Token counting and budgeted prompt assembly for AnswerAgent.
+
+Counts use tiktoken when it is installed and otherwise fall back to an
+estimate (one token per CJK character, four characters per token for the
+rest), which is close enough to keep prompts inside a budget.
+"""
+import os
+import re
+
+_CJK_RE = re.compile(r"[㐀-鿿　-〿＀-￯]")
+_encoding = None
+_encoding_loaded = False
+
+
+# tiktoken encoding, or None when tiktoken is not installed; imported on
+# first use to keep it off the startup path
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(os.environ.get("PROMPT_TOKENIZER", "cl100k_base"))
+        except ImportError:
+            _encoding = None
+        _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    if _get_encoding() is not None:
+        return len(_get_encoding().encode(text, disallowed_special=()))
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def truncate_to_tokens(text, max_tokens):
+    if max_tokens <= 0:
+        return ""
+    if _get_encoding() is not None:
+        tokens = _get_encoding().encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else _get_encoding().decode(tokens[:max_tokens])
+    while count_tokens(text) > max_tokens:
+        text = text[:int(len(text) * max_tokens / count_tokens(text) * 0.95)]
+    return text
+
+
+def format_source(source):
+    return "\n{title: '" + source["title"] + "', content: '" + source["content"] + "'},\n"
+
+
+def format_sources(sources):
+    return "".join(format_source(source) for source in sources)
+
+
+def format_qna(chat):
+    return "- Question: " + chat[0] + "\n- Answer: " + chat[1] + "\n"
+
+
+def _shingles(text, size=5):
+    text = re.sub(r"\s+", " ", text.lower())
+    return {text[i:i + size] for i in range(max(len(text) - size + 1, 1))}
+
+
+def near_duplicate(shingles, other, threshold):
+    union = len(shingles | other)
+    return union > 0 and len(shingles & other) / union >= threshold
+
+
+class PromptBudget:
+    """Token limits for one AnswerAgent prompt.
+
+    total: whole prompt (system + user message)
+    history: verbatim Q/A pairs; older pairs are folded into a summary
+    min_source_tokens: a source is only truncated to fit if at least this
+        many tokens of it still fit, otherwise it is dropped
+    duplicate_threshold: character-shingle Jaccard similarity above which a
+        source is dropped as a near-duplicate of a higher-ranked one
+    """
+
+    def __init__(self, total=None, history=None, min_source_tokens=64, duplicate_threshold=0.85):
+        self.total = total or int(os.environ.get("PROMPT_TOKEN_BUDGET", "6000"))
+        self.history = history or int(os.environ.get("PROMPT_HISTORY_BUDGET", "1500"))
+        self.min_source_tokens = min_source_tokens
+        self.duplicate_threshold = duplicate_threshold
+
+    # Index of the first Q/A pair kept verbatim: chat_history[start:] is the
+    # longest suffix that fits the history budget
+    def history_start(self, chat_history):
+        used = 0
+        start = len(chat_history)
+        while start > 0:
+            tokens = count_tokens(format_qna(chat_history[start - 1]))
+            if used + tokens > self.history:
+                break
+            used += tokens
+            start -= 1
+        return start
+
+    # Split chat_history into (older, recent) at history_start
+    def split_history(self, chat_history):
+        start = self.history_start(chat_history)
+        return chat_history[:start], chat_history[start:]
+
+    # Fit ranked sources into max_tokens, most relevant first. Returns the
+    # formatted sources and a report of what was kept.
+    def fit_sources(self, sources, max_tokens):
+        report = {"sources_used": 0, "sources_duplicate": 0, "sources_truncated": 0,
+                  "sources_dropped": 0, "sources_tokens": 0, "source_keys": []}
+        kept = []
+        seen = []
+        remaining = max_tokens
+        for source in sources:
+            shingles = _shingles(source["content"])
+            if any(near_duplicate(shingles, other, self.duplicate_threshold) for other in seen):
+                report["sources_duplicate"] += 1
+                continue
+            text = format_source(source)
+            tokens = count_tokens(text)
+            if tokens > remaining:
+                overhead = count_tokens(format_source({"title": source["title"], "content": ""}))
+                if remaining - overhead < self.min_source_tokens:
+                    report["sources_dropped"] += 1
+                    continue
+                text = format_source({"title": source["title"],
+                                      "content": truncate_to_tokens(source["content"], remaining - overhead)})
+                tokens = count_tokens(text)
+                report["sources_truncated"] += 1
+            seen.append(shingles)
+            kept.append(text)
+            remaining -= tokens
+            report["sources_used"] += 1
+            report["source_keys"].append(source.get("key"))
+            report["sources_tokens"] += tokens
+        return "".join(kept), report
@@ -1,9 +1,28 @@
 import csv
-    
-def read_topics_from_file():
+import os
+import threading
+
+TOPICS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "topic_translation.csv")
+
+# path -> (mtime, (TOPICS, TOPIC_NAMES))
+_topics_cache = {}
+_topics_lock = threading.Lock()
+
+
+# Parsed topic table, cached until the file's mtime changes
+def read_topics_from_file(path=TOPICS_FILE):
+    mtime = os.stat(path).st_mtime_ns
+    with _topics_lock:
+        cached = _topics_cache.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = _topics_cache[path] = (mtime, _parse_topics(path))
+    return cached[1]
+
+
+def _parse_topics(path):
     TOPIC_NAMES = {}
     TOPICS = ""
-    with open("./topic_translation.csv", 'r', encoding='utf8') as file:
+    with open(path, 'r', encoding='utf8') as file:
         csv_reader = csv.reader(file)
         next(csv_reader)  # Skip header row if present
         for row in csv_reader:
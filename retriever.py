@@ -0,0 +1,299 @@
+"""Retrievers behind Agent.search.
+
+AzureRetriever queries Azure AI Search. LocalRetriever serves the same
+`topic`-filtered queries from an on-disk index built by this module: a BM25
+inverted index plus an optional memory-mapped matrix of normalized dense
+vectors, with reciprocal rank fusion when both are used.
+
+    python retriever.py export --out corpus.jsonl
+    python retriever.py build --input corpus.jsonl --out index/ [--vectors]
+    python retriever.py query --index index/ --topic landlordTenant "mold in my flat"
+
+Corpus JSONL fields: id, title, content, topic.
+"""
+import argparse
+import json
+import os
+import re
+import tracing
+
+# Reciprocal rank fusion constant, as used by Azure AI Search hybrid queries
+RRF_K = 60
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+|[㐀-鿿]+")
+_CJK_RE = re.compile(r"[㐀-鿿]")
+
+
+# Lowercased words; CJK runs become character unigrams and bigrams
+def tokenize(text):
+    tokens = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        if _CJK_RE.match(token):
+            tokens.extend(token)
+            tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+        else:
+            tokens.append(token)
+    return tokens
+
+
+class Retriever:
+    # Field of the result dicts holding the document key; local indexes
+    # always store it as "id"
+    key_field = "id"
+
+    # Returns result dicts with at least title, content and @search.score
+    def search(self, query, top_k=5, topics=None, vector_search=False, language="en-us"):
+        raise NotImplementedError("search not implemented")
+
+    async def asearch(self, query, top_k=5, topics=None, vector_search=False, language="en-us"):
+        return self.search(query, top_k, topics, vector_search, language)
+
+
+# Semantic answers come back per query rather than per document; attach
+# each one's text to the result it was extracted from, as @search.answers
+def attach_answers(results, answers, key_field="id"):
+    by_key = {}
+    for answer in answers or []:
+        by_key.setdefault(answer.key, []).append(answer.text)
+    for result in results:
+        result["@search.answers"] = by_key.get(result.get(key_field), [])
+    return results
+
+
+class AzureRetriever(Retriever):
+    # key_field: the index's document key field
+    def __init__(self, client, async_client_factory, key_field="id"):
+        self.client = client
+        self._async_client_factory = async_client_factory
+        self.key_field = key_field
+
+    def _search_kwargs(self, query, top_k, topics, vector_search, language):
+        from azure.search.documents.models import VectorizableTextQuery
+        from azure.search.documents.models import QueryType, QueryCaptionType, QueryAnswerType
+        FILTERSTR = "search.in(topic, '{}' , '|')"
+        filter = FILTERSTR.format(
+            '|'.join(["{}".format(topic) for topic in topics])) if topics else None
+
+        # vector search
+        if vector_search:
+            vector_query = VectorizableTextQuery(
+                text=query, k=1, fields="vector", exhaustive=True)
+
+        return dict(
+            search_text=query,
+            vector_queries=[vector_query] if vector_search else None,
+            query_type=QueryType.SEMANTIC,  semantic_configuration_name="default",
+            query_caption=QueryCaptionType.EXTRACTIVE, query_answer=QueryAnswerType.EXTRACTIVE,
+            top=top_k,
+            filter=filter,
+            query_language=language
+        )
+
+    def search(self, query, top_k=5, topics=None, vector_search=False, language="en-us"):
+        results = self.client.search(
+            **self._search_kwargs(query, top_k, topics, vector_search, language))
+        return attach_answers(list(results), results.get_answers(), self.key_field)
+
+    async def asearch(self, query, top_k=5, topics=None, vector_search=False, language="en-us"):
+        results = await self._async_client_factory().search(
+            **self._search_kwargs(query, top_k, topics, vector_search, language))
+        documents = [result async for result in results]
+        return attach_answers(documents, await results.get_answers(), self.key_field)
+
+
+class LocalRetriever(Retriever):
+    def __init__(self, path):
+        import numpy as np
+        self.path = path
+        with open(os.path.join(path, "meta.json"), 'r', encoding='utf8') as file:
+            self.meta = json.load(file)
+        with open(os.path.join(path, "documents.jsonl"), 'r', encoding='utf8') as file:
+            self.documents = [json.loads(line) for line in file]
+        with open(os.path.join(path, "vocab.json"), 'r', encoding='utf8') as file:
+            self.vocab = json.load(file)
+
+        index = np.load(os.path.join(path, "bm25.npz"))
+        self.offsets = index["offsets"]
+        self.postings = index["postings"]
+        self.term_freqs = index["term_freqs"]
+        self.idf = index["idf"]
+        self.doc_topics = index["doc_topics"]
+        self.topic_names = list(self.meta["topics"])
+        self.k1 = self.meta["k1"]
+        # Per-document BM25 length normalisation, precomputed once
+        doc_lengths = index["doc_lengths"]
+        self.length_norm = self.k1 * (1 - self.meta["b"] + self.meta["b"] * doc_lengths / self.meta["avgdl"])
+
+        vectors_path = os.path.join(path, "vectors.npy")
+        self.vectors = np.load(vectors_path, mmap_mode="r") if os.path.exists(vectors_path) else None
+
+    # BM25 scoring and the query embedding block, so they run on a worker
+    # thread rather than the event loop every session shares
+    async def asearch(self, query, top_k=5, topics=None, vector_search=False, language="en-us"):
+        return await tracing.to_thread(self.search, query, top_k, topics, vector_search, language)
+
+    def _topic_mask(self, topics):
+        import numpy as np
+        if not topics:
+            return None
+        ids = [self.topic_names.index(topic) for topic in topics if topic in self.topic_names]
+        return np.isin(self.doc_topics, ids)
+
+    def bm25_scores(self, query):
+        import numpy as np
+        scores = np.zeros(len(self.documents), dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = self.postings[start:end]
+            tf = self.term_freqs[start:end]
+            scores[docs] += self.idf[term_id] * tf * (self.k1 + 1) / (tf + self.length_norm[docs])
+        return scores
+
+    def dense_scores(self, query):
+        import numpy as np
+        from embeddingHelper import embed_texts, normalize
+        query_vector = normalize(embed_texts([query])[0]).astype(self.vectors.dtype)
+        return np.asarray(self.vectors @ query_vector, dtype=np.float32)
+
+    def _ranked(self, scores, mask, top_k, positive_only):
+        import numpy as np
+        candidates = np.flatnonzero(scores > 0) if positive_only else np.arange(len(scores))
+        if mask is not None:
+            candidates = candidates[mask[candidates]]
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k)[:top_k]]
+        return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+    def search(self, query, top_k=5, topics=None, vector_search=False, language="en-us"):
+        mask = self._topic_mask(topics)
+        # Rank deeper than top_k before fusing so both lists contribute
+        depth = max(top_k * 4, 50)
+        bm25 = self.bm25_scores(query)
+        rankings = [self._ranked(bm25, mask, depth, positive_only=True)]
+        if vector_search and self.vectors is not None:
+            rankings.append(self._ranked(self.dense_scores(query), mask, depth, positive_only=False))
+
+        if len(rankings) == 1:
+            ranked = rankings[0][:top_k]
+            scores = bm25[ranked]
+        else:
+            fused = {}
+            for ranking in rankings:
+                for rank, doc in enumerate(ranking):
+                    fused[doc] = fused.get(doc, 0.0) + 1.0 / (RRF_K + rank + 1)
+            ranked = sorted(fused, key=fused.get, reverse=True)[:top_k]
+            scores = [fused[doc] for doc in ranked]
+
+        results = []
+        for doc, score in zip(ranked, scores):
+            result = dict(self.documents[doc])
+            result["@search.score"] = float(score)
+            results.append(result)
+        return results
+
+
+# --------- Index build ------------
+
+def build_index(documents, path, vectors=False, k1=1.2, b=0.75):
+    import numpy as np
+    os.makedirs(path, exist_ok=True)
+    topic_names = sorted({document.get("topic", "") for document in documents})
+
+    vocab = {}
+    postings = {}
+    doc_lengths = np.zeros(len(documents), dtype=np.float32)
+    for doc, document in enumerate(documents):
+        tokens = tokenize(document["title"] + " " + document["content"])
+        doc_lengths[doc] = len(tokens)
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            term_id = vocab.setdefault(token, len(vocab))
+            postings.setdefault(term_id, []).append((doc, count))
+
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    for term_id in range(len(vocab)):
+        offsets[term_id + 1] = offsets[term_id] + len(postings[term_id])
+    flat = [posting for term_id in range(len(vocab)) for posting in postings[term_id]]
+    doc_freqs = np.diff(offsets).astype(np.float32)
+    num_docs = len(documents)
+
+    np.savez_compressed(
+        os.path.join(path, "bm25.npz"),
+        offsets=offsets,
+        postings=np.array([doc for doc, _ in flat], dtype=np.int32),
+        term_freqs=np.array([count for _, count in flat], dtype=np.float32),
+        idf=np.log(1 + (num_docs - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32),
+        doc_lengths=doc_lengths,
+        doc_topics=np.array([topic_names.index(document.get("topic", "")) for document in documents],
+                            dtype=np.int16),
+    )
+    with open(os.path.join(path, "vocab.json"), 'w', encoding='utf8') as file:
+        json.dump(vocab, file, ensure_ascii=False)
+    with open(os.path.join(path, "documents.jsonl"), 'w', encoding='utf8') as file:
+        for document in documents:
+            file.write(json.dumps({key: document.get(key) for key in ("id", "title", "content", "topic")},
+                                  ensure_ascii=False) + "\n")
+    with open(os.path.join(path, "meta.json"), 'w', encoding='utf8') as file:
+        json.dump({"num_docs": num_docs, "k1": k1, "b": b,
+                   "avgdl": float(doc_lengths.mean()) if num_docs else 0.0,
+                   "topics": topic_names,
+                   "embedding_deployment": os.environ.get("AZURE_OPENAI_EMBEDDING_DEPLOYMENT") if vectors else None},
+                  file)
+
+    if vectors:
+        from embeddingHelper import embed_texts, normalize
+        matrix = normalize(embed_texts([document["title"] + "\n" + document["content"]
+                                        for document in documents]))
+        np.save(os.path.join(path, "vectors.npy"), matrix.astype(np.float16))
+
+
+def read_corpus(path):
+    with open(path, 'r', encoding='utf8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+# Dump the Azure AI Search index into a corpus file for build_index
+def export_azure_index(out):
+    from agents import Agent, SearchAgentConfig
+    agent = Agent(SearchAgentConfig(
+        endpoint=os.environ.get("AZURE_SEARCH_ENDPOINT"),
+        index=os.environ.get("AZURE_SEARCH_INDEX"),
+        credential=os.environ.get("AZURE_SEARCH_KEY")
+    ))
+    with open(out, 'w', encoding='utf8') as file:
+        for number, result in enumerate(agent.search_client.search(search_text="*")):
+            file.write(json.dumps({"id": result.get(agent.search_config.key_field, str(number)),
+                                   "title": result["title"],
+                                   "content": result["content"], "topic": result.get("topic", "")},
+                                  ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="export the Azure AI Search index to JSONL")
+    export.add_argument("--out", required=True)
+    build = commands.add_parser("build", help="build a local index from a JSONL corpus")
+    build.add_argument("--input", required=True)
+    build.add_argument("--out", required=True)
+    build.add_argument("--vectors", action="store_true", help="also embed documents for hybrid search")
+    query = commands.add_parser("query", help="query a local index")
+    query.add_argument("--index", required=True)
+    query.add_argument("--topic", action="append")
+    query.add_argument("--top", type=int, default=5)
+    query.add_argument("--vector", action="store_true")
+    query.add_argument("text")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_azure_index(args.out)
+    elif args.command == "build":
+        build_index(read_corpus(args.input), args.out, vectors=args.vectors)
+    else:
+        for result in LocalRetriever(args.index).search(args.text, args.top, args.topic, args.vector):
+            print(f"{result['@search.score']:.4f}  [{result['topic']}] {result['title']}")
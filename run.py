@@ -1,58 +1,344 @@
-from agents import QuestionAgent, AnswerAgent, UserResponseAgent, SearchAgentConfig
+from agents import QuestionAgent, AnswerAgent, UserResponseAgent, SearchAgentConfig, TopicClassifier, Conversation
 from evalAgent import EvalAgent
-import multiprocessing as mp
+from semanticCache import SemanticCache
+import turnPolicy
+import tracing
+from workerPool import POOL
+import asyncio
+import contextvars
 import os
 import logging
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
 SIMILARITY_THRESHOLD = 0.85
+# Seconds each agent call may take in Chat.complete before it is cancelled
+AGENT_CALL_TIMEOUT = float(os.environ.get("AGENT_CALL_TIMEOUT", "120"))
+# Number of topics searches are restricted to; 0 (the default) searches every topic
+TOPIC_FILTER_TOP_K = int(os.environ.get("TOPIC_FILTER_TOP_K", "0"))
+# With topic filtering on, classify the opening problem statement in the
+# background while the user answers the first question, and filter later
+# turns' searches by its topics; 0 classifies each reply instead
+PREFETCH = os.environ.get("PREFETCH", "1") != "0"
+# Entries in the semantic answer cache shared by every session; 0 disables it
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "0"))
 SEARCH_CONFIG = SearchAgentConfig(
         endpoint=os.environ.get("AZURE_SEARCH_ENDPOINT"),
         index=os.environ.get("AZURE_SEARCH_INDEX"),
-        credential=os.environ.get("AZURE_SEARCH_KEY")
+        credential=os.environ.get("AZURE_SEARCH_KEY"),
+        local_index=os.environ.get("LOCAL_SEARCH_INDEX")
     )
-answerAgent = AnswerAgent(SEARCH_CONFIG)
+_sharedAgents = {}
+_sharedAgentsLock = threading.Lock()
 
-def generateResponseMP(query, chatHistory, responseRef) -> None:
-    response = answerAgent.RAG(query, chatHistory)
-    responseRef.value = response
+# Agents hold no per-session state, so one of each is shared by every Chat;
+# they are built by the first Chat rather than at import
+AGENT_FACTORIES = {
+    "question": QuestionAgent,
+    "answer": lambda: AnswerAgent(SEARCH_CONFIG, TopicClassifier(), TOPIC_FILTER_TOP_K,
+                                  answer_cache=SemanticCache(ANSWER_CACHE_SIZE) if ANSWER_CACHE_SIZE else None),
+    "user_response": UserResponseAgent,
+    "eval": lambda: EvalAgent('OpenAIEmbedding'),
+}
+
+def get_shared_agent(name):
+    with _sharedAgentsLock:
+        if name not in _sharedAgents:
+            _sharedAgents[name] = AGENT_FACTORIES[name]()
+        return _sharedAgents[name]
+
+def get_answer_agent():
+    return get_shared_agent("answer")
+
+def __getattr__(name):
+    if name == "answerAgent":
+        return get_answer_agent()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Await an agent call as a traced stage of the current turn
+async def call_with_timeout(stage, coro):
+    return await asyncio.wait_for(tracing.traced(stage, coro), AGENT_CALL_TIMEOUT)
+
+async def gather_or_cancel(*coros):
+    # Like asyncio.gather, but a failure in one branch cancels the others
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+async def result_of(future):
+    return await future
+
+class Prefetch:
+    __slots__ = ("query", "future", "started")
+
+    def __init__(self, query, future):
+        self.query = query
+        self.future = future
+        self.started = time.monotonic()
 
 class Chat:
-    def __init__(self):
-        self._questionAgent = QuestionAgent()
-        self._answerAgent = answerAgent
-        self._userResponseAgent = UserResponseAgent()
-        self._evalAgent = EvalAgent('OpenAIEmbedding')
-        self._chatHistory = []
+    # Per-session state only; with __slots__ and shared agents an idle Chat
+    # costs little more than its conversation text
+    __slots__ = ("_questionAgent", "_answerAgent", "_userResponseAgent", "_evalAgent", "_policy",
+                 "_chatHistory", "_userQuery", "_previous_question", "_similarities",
+                 "_previousSources", "_skippedTurns", "_prefetch", "_topics", "last_turn")
+
+    # policy: turnPolicy.TurnPolicy deciding whether a turn needs the
+    # speculative simulation; defaults to the one named by TURN_POLICY
+    def __init__(self, policy=None):
+        self._questionAgent = get_shared_agent("question")
+        self._answerAgent = get_answer_agent()
+        self._userResponseAgent = get_shared_agent("user_response")
+        self._evalAgent = get_shared_agent("eval")
+        self._chatHistory = Conversation()
         self._userQuery = ""
+        self._previous_question = None
+        self._policy = policy or turnPolicy.make_policy(threshold=SIMILARITY_THRESHOLD)
+        self._similarities = []
+        self._previousSources = None
+        self._skippedTurns = 0
+        self._prefetch = None
+        # Topics of the problem statement that later searches are filtered by
+        self._topics = None
+        self.last_turn = None
+
+    # JSON-serialisable conversation state, restored by from_dict
+    def to_dict(self):
+        return {
+            "user_query": self._userQuery,
+            "previous_question": self._previous_question,
+            "history": [list(turn) for turn in self._chatHistory],
+            "similarities": self._similarities,
+            "previous_sources": self._previousSources,
+            "skipped_turns": self._skippedTurns,
+            "seen_sources": sorted(self._chatHistory.seen_sources()),
+            "topics": self._topics,
+        }
+
+    @classmethod
+    def from_dict(cls, state, policy=None):
+        chat = cls(policy)
+        chat._userQuery = state["user_query"]
+        chat._previous_question = state["previous_question"]
+        chat._chatHistory = Conversation(tuple(turn) for turn in state["history"])
+        chat._similarities = list(state["similarities"])
+        chat._previousSources = state["previous_sources"]
+        chat._skippedTurns = state["skipped_turns"]
+        chat._chatHistory.mark_seen(state.get("seen_sources", []))
+        chat._topics = state.get("topics")
+        return chat
+
+    # (role, content) of every message so far, for redisplaying a session
+    def transcript(self):
+        if self._userQuery == "":
+            return []
+        messages = [("user", self._userQuery)]
+        for question, answer in self._chatHistory:
+            messages += [("assistant", question), ("user", answer)]
+        if self._previous_question is not None:
+            messages.append(("assistant", self._previous_question))
+        return messages
+
+    # Approximate bytes held by this session's conversation
+    def memory_size(self):
+        return self._chatHistory.memory_size() + sum(
+            len(text or "") for text in (self._userQuery, self._previous_question))
 
     def appendToChatHistory(self, sysMsg, userMsg):
         self._chatHistory.append((sysMsg, userMsg))
 
     def complete(self, query):
+        return POOL.run(self.acomplete(query))
+
+    # Classify the problem statement on the worker pool; a prefetch is
+    # only an optimisation, so it is skipped rather than queued when the
+    # pool is full
+    def _start_prefetch(self, query):
+        if not PREFETCH or not self._answerAgent.filters_topics:
+            return
+        try:
+            # An empty context keeps its spans out of the current turn's trace
+            future = contextvars.Context().run(
+                POOL.submit, self._answerAgent.search_topics, query, timeout=0)
+        except TimeoutError:
+            tracing.note("prefetch", {"started": False})
+            return
+        self._prefetch = Prefetch(query, future)
+
+    # Topics to filter query's search by: the prefetched problem statement
+    # topics, dropped for good once a reply changes the subject; None lets
+    # AnswerAgent classify query itself
+    async def _atopics(self, query):
+        prefetch, self._prefetch = self._prefetch, None
+        if prefetch is not None:
+            with tracing.span("prefetch") as span:
+                span.cache_hit = prefetch.future.done()
+                try:
+                    self._topics = await asyncio.wait_for(
+                        asyncio.wrap_future(prefetch.future), AGENT_CALL_TIMEOUT)
+                except Exception as error:
+                    logger.warning(f"topic prefetch failed: {error!r}")
+            tracing.note("prefetch", {"ready": span.cache_hit, "age": time.monotonic() - prefetch.started,
+                                      "topics": self._topics})
+        if self._topics and await tracing.to_thread(self._answerAgent.changes_subject, query, self._topics):
+            tracing.note("prefetch", {"dropped": self._topics})
+            self._topics = None
+        return self._topics
+
+    # Yields the reply as it is generated; once exhausted, the full
+    # (msg, metas, exit, trace) tuple of complete() is available in self.last_turn
+    def complete_stream(self, query):
         if self._userQuery == "":
             self._userQuery = query
-            question = self._questionAgent.RAG(query)
+            trace, token = tracing.start_turn(0)
+            self._start_prefetch(query)
+            chunks = []
+            try:
+                with tracing.span("question"):
+                    for delta in self._questionAgent.RAG_stream(query):
+                        chunks.append(delta)
+                        yield delta
+            finally:
+                tracing.finish_turn(trace, token)
+            question = "".join(chunks)
+            self._previous_question = question
+            self.last_turn = (question, None, False, trace)
+            return
+
+        # A simulated turn can only pick between the question and the response
+        # once both full texts have been compared, so that reply is yielded
+        # whole; when the policy decides up front, the reply is streamed
+        trace, token = tracing.start_turn(len(self._chatHistory))
+        try:
+            decision, retrieval = POOL.run(self._adecide(query))
+            if decision == turnPolicy.SIMULATE:
+                msg, metas, exit = POOL.run(self._asimulate(query, retrieval))
+                yield msg
+            else:
+                stage = "response" if decision == turnPolicy.ANSWER else "question"
+                chunks = []
+                used = []
+                prefetched = POOL.run(result_of(retrieval)) if decision == turnPolicy.ANSWER else None
+                stream = self._answerAgent.RAG_stream(query, self._chatHistory, used, prefetched) \
+                    if decision == turnPolicy.ANSWER else self._questionAgent.RAG_stream(query, self._chatHistory)
+                with tracing.span(stage):
+                    for delta in stream:
+                        chunks.append(delta)
+                        yield delta
+                self._chatHistory.mark_seen(used)
+                msg = "".join(chunks)
+                self._previous_question = msg
+                metas = (msg, None, None, None, None) if decision == turnPolicy.ASK else \
+                    (None, None, msg, None, None)
+                exit = False
+        finally:
+            tracing.finish_turn(trace, token)
+        self.last_turn = (msg, metas, exit, trace)
+
+    # Returns (msg, metas, exit, trace); trace is the tracing.TurnTrace of
+    # per-stage timings and token usage for this turn
+    async def acomplete(self, query):
+        trace, token = tracing.start_turn(len(self._chatHistory))
+        try:
+            msg, metas, exit = await self._acomplete(query)
+        finally:
+            tracing.finish_turn(trace, token)
+        return msg, metas, exit, trace
+
+    async def _acomplete(self, query):
+        if self._userQuery == "":
+            self._userQuery = query
+            # Classification runs alongside the question and the user's reply
+            self._start_prefetch(query)
+            question = await call_with_timeout(
+                "question", self._questionAgent.aRAG(query))
             self._previous_question = question
             return question, None, False
-        
+
+        decision, retrieval = await self._adecide(query)
+        if decision == turnPolicy.ANSWER:
+            used = []
+            response = await call_with_timeout(
+                "response", self._answerAgent.aRAG(query, self._chatHistory, used, await retrieval))
+            self._chatHistory.mark_seen(used)
+            self._previous_question = response
+            return response, (None, None, response, None, None), False
+        if decision == turnPolicy.ASK:
+            question = await call_with_timeout(
+                "question", self._questionAgent.aRAG(query, self._chatHistory))
+            self._previous_question = question
+            return question, (question, None, None, None, None), False
+        return await self._asimulate(query, retrieval)
+
+    # Record the user's reply and ask the turn policy whether this turn
+    # needs the speculative simulation. Returns (decision, retrieval):
+    # retrieval is a task started right away for the (topics, sources) of
+    # query, shared by the policy and every AnswerAgent call of the turn
+    async def _adecide(self, query):
         self._chatHistory.append((self._previous_question, query))
-        # Generate new question
-        question = self._questionAgent.RAG(query, self._chatHistory)
-        # Generate mock answer
-        mock_answer = self._userResponseAgent.RAG(
-            query, question, self._chatHistory)
-        # Gerenate dummy response
-        dummy_response = self._answerAgent.RAG(query, self._chatHistory + [(question, mock_answer)])
+        topics = await self._atopics(query)
+        retrieval = asyncio.ensure_future(call_with_timeout("retrieve", self._answerAgent.aretrieve(query, topics)))
+        overlap = None
+        if self._policy.needs_retrieval:
+            sources = (await retrieval)[1]
+            keys = [source["key"] for source in sources]
+            if self._previousSources is not None:
+                overlap = turnPolicy.overlap(keys, self._previousSources)
+            self._previousSources = keys
+        signals = turnPolicy.TurnSignals(
+            len(self._chatHistory), self._similarities, overlap, self._skippedTurns)
+        decision = self._policy.decide(signals)
+        skipped = turnPolicy.STATS.record(decision, signals)
+        tracing.note("policy", {"decision": decision, "skipped": list(skipped), **signals.to_dict()})
+        self._skippedTurns = 0 if decision == turnPolicy.SIMULATE else self._skippedTurns + 1
+        if decision == turnPolicy.ASK:
+            retrieval.cancel()
+        return decision, retrieval
+
+    async def _asimulate(self, query, retrieval):
+        chatHistory = self._chatHistory
+
+        async def speculate():
+            # Generate new question
+            question = await call_with_timeout(
+                "question", self._questionAgent.aRAG(query, chatHistory))
+            # Generate mock answer
+            mock_answer = await call_with_timeout("mock_answer", self._userResponseAgent.aRAG(
+                query, question, chatHistory))
+            # Gerenate dummy response
+            # The mock answer is made up, so the dummy response must neither
+            # come from nor go into the answer cache
+            dummy_response = await call_with_timeout("dummy_response", self._answerAgent.aRAG(
+                query, chatHistory + [(question, mock_answer)], prefetched=await retrieval, use_cache=False))
+            return question, mock_answer, dummy_response
+
+        # Generate real query response for the current round alongside the
+        # speculative question -> mock answer -> dummy response chain
+        used = []
+        cache_entry = []
+
+        async def respond():
+            return await self._answerAgent.aRAG(
+                query, chatHistory, used, await retrieval, cache_entry=cache_entry)
 
-        # Generate real query response for the current round
-        response = self._answerAgent.RAG(query, self._chatHistory)
+        (question, mock_answer, dummy_response), response = await gather_or_cancel(
+            speculate(), call_with_timeout("response", respond()))
 
         # Bepare similarity
-        similarity = self._evalAgent.evaluvate(response, dummy_response)
+        similarity = await call_with_timeout("similarity", tracing.to_thread(
+            self._evalAgent.evaluvate, response, dummy_response))
+        self._similarities.append(similarity)
         if (similarity >= SIMILARITY_THRESHOLD):
             # Generate query response
+            self._chatHistory.mark_seen(used)
+            for vector, topics in cache_entry:
+                self._answerAgent.cache_answer(vector, topics, response)
             self._previous_question = response
             return response, (question, mock_answer, response, dummy_response, similarity), False
         else:
@@ -73,9 +359,9 @@ class Chat:
         while True:
             if answer == "exit()":
                 break
-            responseRef = mp.Manager().Value(str, "")
-            responseMP = mp.Process(target=generateResponseMP, args=(query, self._chatHistory, responseRef))
-            responseMP.start()
+            cache_entry = []
+            responseFuture = POOL.submit(
+                self._answerAgent.RAG, query, self._chatHistory, cache_entry=cache_entry)
 
             # Generate new question
             question = self._questionAgent.RAG(query, self._chatHistory)
@@ -83,12 +369,12 @@ class Chat:
             mock_answer = self._userResponseAgent.RAG(
                 query, question, self._chatHistory)
             # Gerenate dummy response
-            dummy_response = self._answerAgent.RAG(query, self._chatHistory + [(question, mock_answer)])
+            dummy_response = self._answerAgent.RAG(
+                query, self._chatHistory + [(question, mock_answer)], use_cache=False)
 
             # Generate real query response for the current round
             # response = self._answerAgent.RAG(query, self._chatHistory)
-            responseMP.join()
-            response = responseRef.value
+            response = responseFuture.result()
 
             # Bepare similarity
             similarity = self._evalAgent.evaluvate(response, dummy_response)
@@ -105,6 +391,8 @@ class Chat:
 
             if (similarity >= SIMILARITY_THRESHOLD):
                 # Generate query response
+                for vector, topics in cache_entry:
+                    self._answerAgent.cache_answer(vector, topics, response)
                 print(f"Sys: {response}")
                 answer = input("User: ")
                 self._chatHistory.append((response, answer))
@@ -0,0 +1,117 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+class SemanticCache:
+    """Approximate answer cache keyed on embeddings.
+
+    Stores normalized context vectors in one preallocated float32 matrix of
+    maxsize rows; a lookup is a single matrix-vector product. The best match
+    at or above threshold is returned (restricted to entries stored under
+    the same topic when same_topic is set). Least recently used entries are
+    evicted when the cache is full, and entries older than max_age seconds
+    are never returned.
+    """
+
+    def __init__(self, maxsize=1024, threshold=None, history_turns=None, same_topic=None, max_age=None):
+        self.maxsize = maxsize
+        self.threshold = threshold or float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.95"))
+        self.history_turns = history_turns if history_turns is not None else \
+            int(os.environ.get("ANSWER_CACHE_HISTORY_TURNS", "2"))
+        self.same_topic = same_topic if same_topic is not None else \
+            os.environ.get("ANSWER_CACHE_SAME_TOPIC", "1") != "0"
+        self.max_age = max_age or float(os.environ.get("ANSWER_CACHE_MAX_AGE", "0")) or None
+        self._vectors = None
+        self._valid = None
+        self._entries = [None] * self.maxsize
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._hit_ages = []
+
+    def __len__(self):
+        return len(self._lru)
+
+    # Text embedded for a turn: the query plus the last history_turns Q/A
+    # pairs, lowercased with whitespace collapsed
+    def context_text(self, query, chat_history=()):
+        recent = list(chat_history[len(chat_history) - self.history_turns:]) if self.history_turns else []
+        parts = [question + "\n" + answer for question, answer in recent] + [query]
+        return re.sub(r"\s+", " ", "\n".join(parts).lower()).strip()
+
+    def _allocate(self, dim):
+        import numpy as np
+        self._vectors = np.zeros((self.maxsize, dim), dtype=np.float32)
+        self._valid = np.zeros(self.maxsize, dtype=bool)
+
+    # (answer, similarity, age in seconds) of the best match, or None
+    def get(self, vector, topic=None):
+        import numpy as np
+        with self._lock:
+            if self._vectors is None or not self._lru:
+                self.misses += 1
+                return None
+            now = time.time()
+            mask = self._valid.copy()
+            for slot in self._lru:
+                _, entry_topic, stored_at = self._entries[slot]
+                if (self.same_topic and entry_topic != topic) or \
+                        (self.max_age is not None and now - stored_at > self.max_age):
+                    mask[slot] = False
+            scores = np.where(mask, self._vectors @ vector.astype(np.float32), -np.inf)
+            slot = int(np.argmax(scores))
+            if scores[slot] < self.threshold:
+                self.misses += 1
+                return None
+            answer, _, stored_at = self._entries[slot]
+            self._lru.move_to_end(slot)
+            self.hits += 1
+            self._hit_ages.append(now - stored_at)
+            del self._hit_ages[:-1000]
+            return answer, float(scores[slot]), now - stored_at
+
+    def put(self, vector, answer, topic=None):
+        with self._lock:
+            if self._vectors is None:
+                self._allocate(len(vector))
+            # Slots fill in order and are only reused once the cache is full
+            if len(self._lru) < self.maxsize:
+                slot = len(self._lru)
+            else:
+                slot, _ = self._lru.popitem(last=False)
+            self._vectors[slot] = vector
+            self._valid[slot] = True
+            self._entries[slot] = (answer, topic, time.time())
+            self._lru[slot] = None
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+            self._entries = [None] * self.maxsize
+            if self._valid is not None:
+                self._valid[:] = False
+            self.hits = 0
+            self.misses = 0
+            self._hit_ages = []
+
+    def stats(self):
+        with self._lock:
+            now = time.time()
+            ages = [now - self._entries[slot][2] for slot in self._lru]
+            hit_ages = sorted(self._hit_ages)
+        total = self.hits + self.misses
+        return {
+            "size": len(ages),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            # Age of the answers served from the cache (last 1000 hits)
+            "hit_age_mean": sum(hit_ages) / len(hit_ages) if hit_ages else 0.0,
+            "hit_age_p95": hit_ages[int(len(hit_ages) * 0.95)] if hit_ages else 0.0,
+            "oldest_entry_age": max(ages) if ages else 0.0,
+        }
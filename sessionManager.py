@@ -0,0 +1,152 @@
+"""Bounded store of Chat sessions for ui.py.
+
+Sessions idle for longer than SESSION_TTL seconds, and the least recently
+used ones beyond SESSION_MAX_LIVE, are spilled to SESSION_SPILL_DIR as JSON
+and dropped from memory; the next request for them restores them. Spilled
+files older than SESSION_SPILL_TTL seconds are deleted. A session is never
+spilled while it is leased with `session()`.
+"""
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from run import Chat
+
+
+class SessionRecord:
+    __slots__ = ("chat", "last_active", "leases")
+
+    def __init__(self, chat):
+        self.chat = chat
+        self.last_active = time.monotonic()
+        self.leases = 0
+
+
+def _rss_bytes():
+    # Resident set size from /proc (Linux); None elsewhere
+    try:
+        with open("/proc/self/statm", 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class SessionManager:
+    def __init__(self, ttl=None, max_live=None, spill_dir=None, spill_ttl=None, sweep_interval=60):
+        self.ttl = ttl or float(os.environ.get("SESSION_TTL", "1800"))
+        self.max_live = max_live or int(os.environ.get("SESSION_MAX_LIVE", "200"))
+        self.spill_dir = spill_dir or os.environ.get(
+            "SESSION_SPILL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "sessions"))
+        self.spill_ttl = spill_ttl or float(os.environ.get("SESSION_SPILL_TTL", str(7 * 24 * 3600)))
+        self.sweep_interval = sweep_interval
+        self.spilled = 0
+        self.restored = 0
+        self._sessions = {}
+        self._last_sweep = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _path(self, session_id):
+        if not re.fullmatch(r"[\w-]+", session_id):
+            raise ValueError(f"invalid session id {session_id!r}")
+        return os.path.join(self.spill_dir, session_id + ".json")
+
+    # Caller must hold self._lock
+    def _spill(self, session_id):
+        record = self._sessions.pop(session_id)
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = self._path(session_id)
+        with open(path + ".tmp", 'w', encoding='utf8') as file:
+            json.dump(record.chat.to_dict(), file, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+        self.spilled += 1
+
+    # Caller must hold self._lock
+    def _restore(self, session_id):
+        path = self._path(session_id)
+        try:
+            with open(path, 'r', encoding='utf8') as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            return Chat()
+        os.remove(path)
+        self.restored += 1
+        return Chat.from_dict(state)
+
+    def _checkout(self, session_id, lease):
+        with self._lock:
+            record = self._sessions.get(session_id)
+            if record is None:
+                record = self._sessions[session_id] = SessionRecord(self._restore(session_id))
+            record.last_active = time.monotonic()
+            record.leases += lease
+            chat = record.chat
+        self.maybe_sweep()
+        return chat
+
+    def get(self, session_id):
+        return self._checkout(session_id, 0)
+
+    # Lease a session for the duration of a turn so it is not spilled mid-turn
+    @contextmanager
+    def session(self, session_id):
+        chat = self._checkout(session_id, 1)
+        try:
+            yield chat
+        finally:
+            with self._lock:
+                record = self._sessions.get(session_id)
+                if record is not None:
+                    record.leases -= 1
+                    record.last_active = time.monotonic()
+
+    def drop(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            path = self._path(session_id)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def maybe_sweep(self):
+        if time.monotonic() - self._last_sweep >= self.sweep_interval or len(self._sessions) > self.max_live:
+            self.sweep()
+
+    # Spill idle and excess sessions, and delete expired spill files
+    def sweep(self):
+        now = time.monotonic()
+        with self._lock:
+            self._last_sweep = now
+            idle = sorted((record.last_active, session_id)
+                          for session_id, record in self._sessions.items() if record.leases == 0)
+            excess = len(self._sessions) - self.max_live
+            for last_active, session_id in idle:
+                if now - last_active > self.ttl or excess > 0:
+                    self._spill(session_id)
+                    excess -= 1
+        if os.path.isdir(self.spill_dir):
+            cutoff = time.time() - self.spill_ttl
+            for name in os.listdir(self.spill_dir):
+                path = os.path.join(self.spill_dir, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            records = list(self._sessions.values())
+        spilled = len(os.listdir(self.spill_dir)) if os.path.isdir(self.spill_dir) else 0
+        return {
+            "live_sessions": len(records),
+            "leased_sessions": sum(1 for record in records if record.leases),
+            "spilled_sessions": spilled,
+            "conversation_bytes": sum(record.chat.memory_size() for record in records),
+            "rss_bytes": _rss_bytes(),
+            "spills_total": self.spilled,
+            "restores_total": self.restored,
+        }
+
+
+SESSIONS = SessionManager()
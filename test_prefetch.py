@@ -0,0 +1,69 @@
+import pytest
+import localBackend
+
+localBackend.enable()
+
+import agents  # noqa: E402
+import run  # noqa: E402
+import turnPolicy  # noqa: E402
+
+QUERY = "My landlord kept my deposit after I moved out. Can I get it back?"
+REPLY = "He says there was damage to the walls."
+
+
+# The shared answer agent with topic filtering on, and the list of topics
+# each of its atopic_search calls filtered by
+@pytest.fixture
+def answer_agent(monkeypatch):
+    agent = run.get_answer_agent()
+    monkeypatch.setattr(agent, "topic_k", 3)
+    searched = []
+    search = agent.atopic_search
+
+    async def spy(query, topics):
+        searched.append(topics)
+        return await search(query, topics)
+    monkeypatch.setattr(agent, "atopic_search", spy)
+    return agent, searched
+
+
+# Opens a conversation and waits, as the user would, for the prefetch
+def opened_chat():
+    agents.SEARCH_CACHE.clear()
+    chat = run.Chat(turnPolicy.AlwaysSimulate())
+    chat.complete(QUERY)
+    assert chat._prefetch is not None
+    chat._prefetch.future.result()
+    return chat
+
+
+def test_prefetched_topics_filter_the_next_search(answer_agent, monkeypatch):
+    answer_agent, searched = answer_agent
+    monkeypatch.setattr(answer_agent, "changes_subject", lambda query, topics: False)
+    expected = answer_agent.search_topics(QUERY)
+    chat = opened_chat()
+    trace = chat.complete(REPLY)[3]
+
+    prefetch = [span for span in trace.spans if span.stage == "prefetch"]
+    assert len(prefetch) == 1 and prefetch[0].cache_hit
+    assert "topics" not in [span.stage for span in trace.spans]
+    assert searched == [expected]
+    assert chat._topics == expected
+    assert run.Chat.from_dict(chat.to_dict())._topics == expected
+
+
+def test_subject_change_drops_prefetched_topics(answer_agent, monkeypatch):
+    answer_agent, searched = answer_agent
+    monkeypatch.setattr(answer_agent, "changes_subject", lambda query, topics: True)
+    chat = opened_chat()
+    trace = chat.complete(REPLY)[3]
+
+    assert chat._topics is None
+    assert "topics" in [span.stage for span in trace.spans]
+    assert searched == [answer_agent.search_topics(REPLY)]
+
+
+def test_no_prefetch_without_topic_filter():
+    chat = run.Chat(turnPolicy.AlwaysSimulate())
+    chat.complete(QUERY)
+    assert chat._prefetch is None
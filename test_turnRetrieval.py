@@ -0,0 +1,59 @@
+import pytest
+import localBackend
+
+localBackend.enable()
+
+import agents  # noqa: E402
+import run  # noqa: E402
+import turnPolicy  # noqa: E402
+
+QUERY = "My landlord kept my deposit after I moved out. Can I get it back?"
+REPLY = "He says there was damage to the walls."
+
+
+@pytest.fixture(autouse=True)
+def topic_filter(monkeypatch):
+    monkeypatch.setattr(run.get_answer_agent(), "topic_k", 3)
+    # Each reply is classified on its own, as without a topic prefetch
+    monkeypatch.setattr(run, "PREFETCH", False)
+
+
+# Topics and sources of a follow-up turn are retrieved once, by the task
+# _adecide starts, and every AnswerAgent call of the turn uses that result
+def follow_up_trace(policy):
+    agents.SEARCH_CACHE.clear()
+    chat = run.Chat(policy)
+    chat.complete(QUERY)
+    return chat.complete(REPLY)[3]
+
+
+def retrieval_spans(trace):
+    return [span for span in trace.spans if span.stage in ("topics", "search")]
+
+
+def test_simulated_turn_classifies_and_searches_once():
+    trace = follow_up_trace(turnPolicy.AlwaysSimulate())
+    stages = [span.stage for span in trace.spans]
+    assert "response" in stages and "dummy_response" in stages
+    spans = retrieval_spans(trace)
+    assert sorted(span.stage for span in spans) == ["search", "topics"]
+    assert all(span.parent == "retrieve" for span in spans)
+
+
+def test_policy_and_answer_share_one_search():
+    policy = turnPolicy.AdaptivePolicy(max_turns=1)
+    trace = follow_up_trace(policy)
+    assert "response" in [span.stage for span in trace.spans]
+    spans = retrieval_spans(trace)
+    assert sorted(span.stage for span in spans) == ["search", "topics"]
+    assert all(span.parent == "retrieve" for span in spans)
+
+
+def test_streamed_answer_uses_the_turn_search():
+    agents.SEARCH_CACHE.clear()
+    chat = run.Chat(turnPolicy.AdaptivePolicy(max_turns=1))
+    "".join(chat.complete_stream(QUERY))
+    assert "".join(chat.complete_stream(REPLY))
+    spans = retrieval_spans(chat.last_turn[3])
+    assert sorted(span.stage for span in spans) == ["search", "topics"]
+    assert all(span.parent == "retrieve" for span in spans)
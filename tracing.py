@@ -0,0 +1,231 @@
+"""Per-turn timing and token-usage traces.
+
+Chat.complete opens a TurnTrace for every turn; agent calls made while it is
+active (in the same task, or in tasks and threads started from it) add spans
+to it. Finished traces are returned from Chat.complete and handed to every
+registered sink.
+"""
+import asyncio
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_current_trace = contextvars.ContextVar("turn_trace", default=None)
+_current_span = contextvars.ContextVar("turn_span", default=None)
+
+
+class Span:
+    __slots__ = ("stage", "parent", "started", "queued", "wall", "prompt_tokens",
+                 "completion_tokens", "cache_hit", "error")
+
+    def __init__(self, stage, parent=None, queued=0.0):
+        self.stage = stage
+        self.parent = parent
+        self.started = time.time()
+        self.queued = queued
+        self.wall = None
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.cache_hit = None
+        self.error = None
+
+    def record_usage(self, usage):
+        if usage is None:
+            return
+        self.prompt_tokens = (self.prompt_tokens or 0) + (usage.prompt_tokens or 0)
+        self.completion_tokens = (self.completion_tokens or 0) + \
+            (getattr(usage, "completion_tokens", None) or 0)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class TurnTrace:
+    def __init__(self, turn):
+        self.turn = turn
+        self.started = time.time()
+        self.wall = None
+        self.spans = []
+        self.notes = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def stage_totals(self):
+        totals = {}
+        for span in self.spans:
+            total = totals.setdefault(span.stage, {"calls": 0, "wall": 0.0, "queued": 0.0,
+                                                   "prompt_tokens": 0, "completion_tokens": 0,
+                                                   "cache_hits": 0})
+            total["calls"] += 1
+            total["wall"] += span.wall or 0.0
+            total["queued"] += span.queued or 0.0
+            total["prompt_tokens"] += span.prompt_tokens or 0
+            total["completion_tokens"] += span.completion_tokens or 0
+            total["cache_hits"] += 1 if span.cache_hit else 0
+        return totals
+
+    def to_dict(self):
+        return {
+            "turn": self.turn,
+            "started": self.started,
+            "wall": self.wall,
+            "prompt_tokens": sum(span.prompt_tokens or 0 for span in self.spans),
+            "completion_tokens": sum(span.completion_tokens or 0 for span in self.spans),
+            "spans": [span.to_dict() for span in self.spans],
+            "notes": self.notes,
+        }
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+# Attach extra structured data (e.g. a prompt token report) to the current turn
+def note(name, data):
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    parent = _current_span.get()
+    with trace._lock:
+        trace.notes.append({"name": name, "stage": parent.stage if parent else None, **data})
+
+
+def start_turn(turn):
+    trace = TurnTrace(turn)
+    return trace, _current_trace.set(trace)
+
+
+def finish_turn(trace, token):
+    trace.wall = time.time() - trace.started
+    _current_trace.reset(token)
+    for sink in SINKS:
+        sink.emit(trace)
+    return trace
+
+
+@contextmanager
+def span(stage, submitted=None):
+    # submitted: time.time() at which the work was queued, if it was
+    trace = _current_trace.get()
+    parent = _current_span.get()
+    current = Span(stage, parent.stage if parent else None,
+                   queued=time.time() - submitted if submitted else 0.0)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as error:
+        current.error = type(error).__name__
+        raise
+    finally:
+        current.wall = time.time() - current.started
+        _current_span.reset(token)
+        if trace is not None:
+            trace.add(current)
+
+
+# Count seconds spent waiting for a worker thread, a rate limit or a
+# concurrency slot as queueing time of the current span
+def add_queued(seconds):
+    current = _current_span.get()
+    if current is not None and seconds > 0:
+        current.queued += seconds
+
+
+# asyncio.to_thread, counting the wait for a free executor thread with add_queued
+async def to_thread(fn, *args, **kwargs):
+    submitted = time.monotonic()
+
+    def run():
+        add_queued(time.monotonic() - submitted)
+        return fn(*args, **kwargs)
+    return await asyncio.to_thread(run)
+
+
+# Await coro inside a span, measuring the time between this call and the
+# moment the coroutine actually starts running as queueing time
+def traced(stage, coro):
+    submitted = time.time()
+
+    async def run():
+        with span(stage, submitted):
+            return await coro
+    return run()
+
+
+# --------- Sinks ------------
+
+class JsonlSink:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, trace):
+        line = json.dumps(trace.to_dict(), ensure_ascii=False)
+        with self._lock, open(self.path, 'a', encoding='utf8') as file:
+            file.write(line + "\n")
+
+
+class PrometheusSink:
+    """Accumulates per-stage counters and renders them in Prometheus text
+    format; with a path, rewrites that file after every turn (for the node
+    exporter textfile collector)."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.turns = 0
+        self.turn_seconds = 0.0
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def emit(self, trace):
+        with self._lock:
+            self.turns += 1
+            self.turn_seconds += trace.wall or 0.0
+            for stage, total in trace.stage_totals().items():
+                current = self.stages.setdefault(stage, dict.fromkeys(total, 0))
+                for name, value in total.items():
+                    current[name] += value
+            text = self.render()
+        if self.path:
+            with open(self.path + ".tmp", 'w', encoding='utf8') as file:
+                file.write(text)
+            os.replace(self.path + ".tmp", self.path)
+
+    def render(self):
+        lines = [
+            "# TYPE chatbot_turns_total counter",
+            f"chatbot_turns_total {self.turns}",
+            "# TYPE chatbot_turn_seconds_total counter",
+            f"chatbot_turn_seconds_total {self.turn_seconds}",
+        ]
+        metrics = [("calls", "chatbot_stage_calls_total"),
+                   ("wall", "chatbot_stage_seconds_total"),
+                   ("queued", "chatbot_stage_queued_seconds_total"),
+                   ("prompt_tokens", "chatbot_stage_prompt_tokens_total"),
+                   ("completion_tokens", "chatbot_stage_completion_tokens_total"),
+                   ("cache_hits", "chatbot_stage_cache_hits_total")]
+        for key, metric in metrics:
+            lines.append(f"# TYPE {metric} counter")
+            for stage, total in sorted(self.stages.items()):
+                lines.append(f'{metric}{{stage="{stage}"}} {total[key]}')
+        return "\n".join(lines) + "\n"
+
+
+SINKS = []
+
+
+def add_sink(sink):
+    SINKS.append(sink)
+    return sink
+
+
+if os.environ.get("TRACE_JSONL"):
+    add_sink(JsonlSink(os.environ["TRACE_JSONL"]))
+if os.environ.get("TRACE_PROMETHEUS_FILE"):
+    add_sink(PrometheusSink(os.environ["TRACE_PROMETHEUS_FILE"]))
@@ -0,0 +1,142 @@
+"""Decides, before each follow-up turn, whether Chat needs the speculative
+question -> mock answer -> dummy response simulation.
+
+A policy returns SIMULATE (run the full pipeline and compare similarities),
+ANSWER (reply with the AnswerAgent response straight away) or ASK (reply with
+a new QuestionAgent question straight away). The last two skip the extra
+LLM and embedding calls; every decision and the stages it skipped are
+counted in STATS and logged.
+"""
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+SIMULATE = "simulate"
+ANSWER = "answer"
+ASK = "ask"
+
+# Stages of Chat._acomplete not run for each decision
+SKIPPED_STAGES = {
+    SIMULATE: (),
+    ANSWER: ("question", "mock_answer", "dummy_response", "similarity"),
+    ASK: ("mock_answer", "dummy_response", "response", "similarity"),
+}
+
+
+class TurnSignals:
+    """Cheap, locally available inputs for a turn's decision.
+
+    turn: number of (question, answer) pairs so far, including this one
+    similarities: response/dummy-response similarity of earlier simulated turns
+    retrieval_overlap: Jaccard overlap of this turn's source keys with the
+        previous turn's, or None when not computed or neither turn retrieved
+        any sources
+    skipped_turns: consecutive turns decided without simulating
+    """
+    __slots__ = ("turn", "similarities", "retrieval_overlap", "skipped_turns")
+
+    def __init__(self, turn, similarities=(), retrieval_overlap=None, skipped_turns=0):
+        self.turn = turn
+        self.similarities = list(similarities)
+        self.retrieval_overlap = retrieval_overlap
+        self.skipped_turns = skipped_turns
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class TurnPolicy:
+    # Whether decide() uses retrieval_overlap; if not, Chat skips the retrieval
+    needs_retrieval = False
+
+    def decide(self, signals):
+        raise NotImplementedError("decide not implemented")
+
+
+class AlwaysSimulate(TurnPolicy):
+    """The original behaviour: simulate on every turn."""
+
+    def decide(self, signals):
+        return SIMULATE
+
+
+class AdaptivePolicy(TurnPolicy):
+    """Skips the simulation when its outcome is predictable.
+
+    ANSWER once max_turns follow-ups have been asked, when this turn retrieves
+    nearly the same sources as the previous one (the user's reply did not
+    change what the answer would be based on), or when the last two simulated
+    similarities are within answer_margin of the threshold and not falling.
+    ASK when the last similarity is more than ask_margin below the threshold
+    and not rising. After max_skipped consecutive skipped turns the next turn
+    is simulated again, so the similarity trend stays current.
+    """
+    needs_retrieval = True
+
+    def __init__(self, threshold=0.85, max_turns=None, overlap_threshold=None,
+                 answer_margin=0.02, ask_margin=0.15, max_skipped=1):
+        self.threshold = threshold
+        self.max_turns = max_turns or int(os.environ.get("TURN_POLICY_MAX_TURNS", "8"))
+        self.overlap_threshold = overlap_threshold or float(os.environ.get("TURN_POLICY_OVERLAP", "0.8"))
+        self.answer_margin = answer_margin
+        self.ask_margin = ask_margin
+        self.max_skipped = max_skipped
+
+    def decide(self, signals):
+        if signals.turn >= self.max_turns:
+            return ANSWER
+        if signals.skipped_turns >= self.max_skipped:
+            return SIMULATE
+        if signals.retrieval_overlap is not None and signals.turn >= 2 and \
+                signals.retrieval_overlap >= self.overlap_threshold:
+            return ANSWER
+        recent = signals.similarities[-2:]
+        if len(recent) == 2 and min(recent) >= self.threshold - self.answer_margin and recent[1] >= recent[0]:
+            return ANSWER
+        if recent and recent[-1] < self.threshold - self.ask_margin and \
+                (len(recent) == 1 or recent[-1] <= recent[0]):
+            return ASK
+        return SIMULATE
+
+
+def make_policy(name=None, threshold=0.85):
+    name = name or os.environ.get("TURN_POLICY", "always")
+    if name == "always":
+        return AlwaysSimulate()
+    if name == "adaptive":
+        return AdaptivePolicy(threshold)
+    raise ValueError(f"unknown turn policy {name!r}, expected 'always' or 'adaptive'")
+
+
+# Jaccard overlap of two collections of source keys; None when both are
+# empty, since two empty retrievals say nothing about the answer
+def overlap(current, previous):
+    current, previous = set(current), set(previous)
+    union = current | previous
+    return len(current & previous) / len(union) if union else None
+
+
+class PolicyStats:
+    def __init__(self):
+        self.decisions = {SIMULATE: 0, ANSWER: 0, ASK: 0}
+        self.skipped_stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, decision, signals):
+        skipped = SKIPPED_STAGES[decision]
+        with self._lock:
+            self.decisions[decision] += 1
+            for stage in skipped:
+                self.skipped_stages[stage] = self.skipped_stages.get(stage, 0) + 1
+        logger.info(f"turn policy: {decision} (skipped {', '.join(skipped) or 'nothing'}) "
+                    f"signals={signals.to_dict()}")
+        return skipped
+
+    def stats(self):
+        with self._lock:
+            return {"decisions": dict(self.decisions), "skipped_stages": dict(self.skipped_stages)}
+
+
+STATS = PolicyStats()
@@ -1,11 +1,26 @@
+import uuid
 import streamlit as st
-from run import Chat
+from sessionManager import SESSIONS
 
 NEXT_Q = ""
 MOCK_USER_ANS = ""
 DUMMY_RESPONSE = ""
 CURR_RESPONSE = ""
 SIMILARITY = 0
+TRACE = None
+
+def write_trace():
+    col2.write(f"#### Timings: {TRACE.wall:.2f}s")
+    col2.table([
+        {"stage": stage,
+         "calls": total["calls"],
+         "wall (s)": round(total["wall"], 2),
+         "queued (s)": round(total["queued"], 3),
+         "prompt tokens": total["prompt_tokens"],
+         "completion tokens": total["completion_tokens"],
+         "cache hits": total["cache_hits"]}
+        for stage, total in TRACE.stage_totals().items()
+    ])
 
 def write_meta():
     #### Current Response:
@@ -24,13 +39,18 @@ def write_meta():
 
 st.set_page_config(layout="wide")
 
-if "model" not in st.session_state:
-    st.session_state["model"] = Chat()
+# Only the session id lives in st.session_state; the conversation is held
+# (and spilled to disk when idle) by the session manager
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = uuid.uuid4().hex
+SESSION_ID = st.session_state.session_id
 
 
 with st.sidebar:
     show_meta = st.toggle("Show metadata", True)
     "[View the source code](https://github.com/HKUGenAI/legal_chatbot)"
+    if show_meta:
+        st.json(SESSIONS.stats(), expanded=False)
 
 
 if show_meta:
@@ -44,26 +64,24 @@ else:
 col1.title("💬 Legal Bot")
 col1.caption("🚀 A streamlit chatbot powered by OpenAI LLM")
 
-if "messages" not in st.session_state:
-    st.session_state["messages"] = [{"role": "assistant", "content": "What legal problem do you face?"}]
-
-for msg in st.session_state.messages:
-    col1.chat_message(msg["role"]).write(msg["content"])
+col1.chat_message("assistant").write("What legal problem do you face?")
+for role, content in SESSIONS.get(SESSION_ID).transcript():
+    col1.chat_message(role).write(content)
 
 if prompt := st.chat_input():
-    st.session_state.messages.append({"role": "user", "content": prompt})
     col1.chat_message("user").write(prompt)
 
-    with st.spinner('Processing...'):
-        msg, metas, exit = st.session_state.model.complete(prompt)
-
-    st.session_state.messages.append({"role": "assistant", "content": msg})
-    col1.chat_message("assistant").write(msg)
+    with st.spinner('Processing...'), SESSIONS.session(SESSION_ID) as model:
+        col1.chat_message("assistant").write_stream(model.complete_stream(prompt))
+        msg, metas, exit, TRACE = model.last_turn
 
     if metas and show_meta:
         NEXT_Q, MOCK_USER_ANS, CURR_RESPONSE ,DUMMY_RESPONSE, SIMILARITY = metas
         write_meta()
 
+    if TRACE and show_meta:
+        write_trace()
+
     if exit:
         col1.info("Session ended!")
         st.stop()
\ No newline at end of file
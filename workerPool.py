@@ -0,0 +1,108 @@
+import asyncio
+import atexit
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import tracing
+
+
+class WorkerPool:
+    """Long-lived executor for agent calls, shared by every session.
+
+    Blocking calls run on a thread pool and coroutines on one event loop
+    thread; both return concurrent.futures.Future. At most max_pending calls
+    may be queued or running at once: further submits block (backpressure),
+    or raise TimeoutError if a timeout is given and no slot frees up.
+    """
+
+    def __init__(self, max_workers=8, max_pending=32):
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="agent-worker")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._loop = None
+        self._loop_thread = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _acquire(self, timeout):
+        if self._closed:
+            raise RuntimeError("worker pool is shut down")
+        waited = time.monotonic()
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError("worker pool is saturated")
+        tracing.add_queued(time.monotonic() - waited)
+
+    def _release(self, _future):
+        self._slots.release()
+
+    def submit(self, fn, *args, timeout=None, **kwargs):
+        self._acquire(timeout)
+        context = contextvars.copy_context()
+        submitted = time.monotonic()
+
+        def run():
+            tracing.add_queued(time.monotonic() - submitted)
+            return fn(*args, **kwargs)
+        try:
+            future = self._executor.submit(context.run, run)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    # The async clients keep connection pools bound to one event loop, so
+    # every coroutine runs on the same long-lived loop
+    def _event_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                # asyncio.to_thread in agent coroutines runs on the pool's
+                # threads, so WORKER_POOL_SIZE bounds that work too
+                self._loop.set_default_executor(self._executor)
+                self._loop_thread = threading.Thread(
+                    target=self._loop.run_forever, name="agent-loop", daemon=True)
+                self._loop_thread.start()
+        return self._loop
+
+    def submit_coroutine(self, coro, timeout=None):
+        try:
+            self._acquire(timeout)
+        except BaseException:
+            coro.close()
+            raise
+        future = asyncio.run_coroutine_threadsafe(coro, self._event_loop())
+        future.add_done_callback(self._release)
+        return future
+
+    def run(self, coro):
+        return self.submit_coroutine(coro).result()
+
+    def shutdown(self, wait=True):
+        self._closed = True
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is not None:
+            cancelled = asyncio.run_coroutine_threadsafe(_cancel_tasks(), loop)
+            if wait:
+                cancelled.result()
+            loop.call_soon_threadsafe(loop.stop)
+            if wait:
+                self._loop_thread.join()
+                loop.close()
+
+
+async def _cancel_tasks():
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+POOL = WorkerPool(
+    max_workers=int(os.environ.get("WORKER_POOL_SIZE", "8")),
+    max_pending=int(os.environ.get("WORKER_POOL_MAX_PENDING", "32"))
+)
+atexit.register(POOL.shutdown)